@@ -1,9 +1,114 @@
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUPS = 5
+
+_local = threading.local()
+_write_lock = threading.RLock()
+_writers = {}
+_writers_lock = threading.Lock()
+_structured = None
+
+
+class LogWriter(object):
+    """Writes a log file from a background thread, rotating it by size."""
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._file = open(path, "a")
+        self._closed = False
+        self._failing = False
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def for_path(path):
+        path = os.path.abspath(path)
+        with _writers_lock:
+            if path not in _writers:
+                _writers[path] = LogWriter(path)
+            return _writers[path]
+
+    def write(self, message):
+        if self._closed:
+            self._file.write(message)
+        else:
+            self._queue.put(message)
+
+    def flush(self):
+        if self._closed or not self._thread.is_alive():
+            self._file.flush()
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        # The file stays open so late writes, e.g. at interpreter shutdown, go straight to it
+        self._queue.put(None)
+        self._thread.join()
+        self._closed = True
+        self._file.flush()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                if isinstance(item, threading.Event):
+                    self._file.flush()
+                    continue
+                if self._file.closed:
+                    # A failed rotation left the file closed
+                    self._file = open(self.path, "a")
+                self._file.write(item)
+                if self.max_bytes and self._file.tell() >= self.max_bytes:
+                    self._rotate()
+                self._failing = False
+            except (OSError, ValueError) as e:
+                # Losing log lines must not stop the migration, report once until writes recover
+                if not self._failing:
+                    self._failing = True
+                    sys.__stderr__.write("Could not write log file {}: {}\n".format(self.path, e))
+            finally:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(self.path, i)):
+                os.replace('{}.{}'.format(self.path, i), '{}.{}'.format(self.path, i + 1))
+        if self.backups:
+            os.replace(self.path, '{}.1'.format(self.path))
+        self._file = open(self.path, "w")
+
+
 class Logger(object):
     def __init__(self, log_file, stream=None):
         self.terminal = stream
-        self.log_file = open(log_file, "a")
+        self.log_file = LogWriter.for_path(log_file)
 
     def write(self, message):
+        block = getattr(_local, 'block', None)
+        if block is not None:
+            block.append((self, message))
+            return
+
+        with _write_lock:
+            self._write(message)
+
+    def _write(self, message):
         if self.terminal:
             self.terminal.write(message)
 
@@ -16,4 +121,70 @@ class Logger(object):
         self.log_file.flush()
 
         if self.terminal:
-            self.terminal.flush()
\ No newline at end of file
+            self.terminal.flush()
+
+
+def begin_block():
+    _local.block = []
+
+
+def flush_block():
+    block = getattr(_local, 'block', None)
+    if not block:
+        return
+
+    with _write_lock:
+        for logger, message in block:
+            logger._write(message)
+        for logger in set(logger for logger, _ in block):
+            logger.flush()
+    del block[:]
+
+
+def end_block():
+    flush_block()
+    _local.block = None
+
+
+def set_context(**context):
+    _local.context = context
+
+
+def enable_structured_log(path):
+    global _structured
+    _structured = LogWriter.for_path(path)
+
+
+def log_event(event, **fields):
+    if _structured is None:
+        return
+    record = dict(getattr(_local, 'context', None) or {}, event=event, time=time.time())
+    record.update(fields)
+    _structured.write(json.dumps(record, default=str) + '\n')
+
+
+def write_terminal(message):
+    # Bypasses the log file, for output that is only meaningful live
+    stream = getattr(sys.stdout, 'terminal', sys.stdout)
+    if stream is None:
+        return
+    with _write_lock:
+        stream.write(message)
+        stream.flush()
+
+
+def flush_logs():
+    flush_block()
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.flush()
+
+
+@atexit.register
+def _close_writers():
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
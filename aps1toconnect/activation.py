@@ -0,0 +1,79 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from aps1toconnect.hub import connection_not_opened
+
+TENANT_ACTIVATION_WORKERS = 8
+TENANT_ACTIVATION_RETRIES = 3
+TENANT_ACTIVATION_BACKOFF = 2
+# Statuses that mean the request was turned away before the tenant was created. A 502,
+# 504 or dropped connection may come after the application created it, and posting
+# again would duplicate the tenant
+TENANT_RETRY_STATUSES = (429, 503)
+
+
+class TenantActivator(object):
+    """Creates the Connect tenant resources of completed orders on a bounded pool.
+
+    submit() returns a future resolved to (tenant_id, error). Every tenant created is
+    written to the ledger before the future resolves, and tenants already in the
+    ledger are not posted again.
+    """
+
+    def __init__(self, aps, ledger, created=None, workers=TENANT_ACTIVATION_WORKERS,
+                 retries=TENANT_ACTIVATION_RETRIES, backoff=TENANT_ACTIVATION_BACKOFF):
+        self.aps = aps
+        self.ledger = ledger
+        self.created = created or {}
+        self.retries = retries
+        self.backoff = backoff
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tenant-activator')
+
+    @classmethod
+    def from_config(cls, aps, migration_config, ledger, created=None):
+        options = migration_config.get('TENANT_ACTIVATION', {})
+        return cls(
+            aps,
+            ledger,
+            created,
+            workers=options.get('workers', TENANT_ACTIVATION_WORKERS),
+            retries=options.get('retries', TENANT_ACTIVATION_RETRIES),
+            backoff=options.get('backoff', TENANT_ACTIVATION_BACKOFF),
+        )
+
+    def submit(self, instance_id, tenant, oss_subscription):
+        return self._executor.submit(self._activate, instance_id, tenant, oss_subscription)
+
+    def stop(self):
+        self._executor.shutdown(wait=True)
+        self.ledger.close()
+
+    def _activate(self, instance_id, tenant, oss_subscription):
+        known = self.created.get(instance_id)
+        if known:
+            return known['tenant_id'], None
+
+        attempt = 0
+        while True:
+            try:
+                r = self.aps.post('aps/2/resources', json=tenant, subscription=oss_subscription)
+            except requests.ConnectionError as e:
+                error = str(e)
+                if not connection_not_opened(e):
+                    return None, error
+            else:
+                if r.ok:
+                    tenant_id = r.json().get('aps', {}).get('id')
+                    self.ledger.record(instance_id, 'tenant_activated', sync=True,
+                                       subscription=oss_subscription, tenant_id=tenant_id)
+                    return tenant_id, None
+                error = f'{r.status_code} {r.text}'
+                if r.status_code not in TENANT_RETRY_STATUSES:
+                    return None, error
+            if attempt >= self.retries:
+                return None, error
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
@@ -0,0 +1,300 @@
+import asyncio
+import json
+import sys
+import time
+from xmlrpc import client as xmlrpc_client
+
+from aps1toconnect.config import get_config
+from aps1toconnect.constants import APS_POOL_SIZE, RPC_WORKERS
+from aps1toconnect.hub import (
+    APS, APS_BATCH_SIZE, APS_CONNECT_PARAMS, APS_PAGE_SIZE, APS_RETRIES, APS_RETRY_BACKOFF, APS_RETRY_STATUSES,
+    RPC_CONNECT_PARAMS, apsapi_raise_for_status, content_range_total, osaapi_raise_for_status,
+)
+from aps1toconnect.profiling import endpoint_pattern, stats
+from aps1toconnect.progress import progress
+from aps1toconnect.records import InstanceRecord
+from aps1toconnect.throttle import aps_budget, governor
+from aps1toconnect.tokens import AsyncTokenManager
+
+# osaapi exposes pem.APS both as .aps and .APS
+RPC_NAMESPACES = {'aps': 'APS'}
+
+
+def _aiohttp():
+    # aiohttp is only needed by the asyncio clients, see the "async" extra in setup.py
+    try:
+        import aiohttp
+    except ImportError:
+        print("The asyncio hub client needs aiohttp, please install it with: pip install aiohttp")
+        sys.exit(1)
+    return aiohttp
+
+
+class AsyncResponse(object):
+    """Status, headers and body of an APS response, read before the connection is released."""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncXMLRPC(object):
+    """XML-RPC over aiohttp, speaking the pem.* API the way osaapi.OSA does."""
+
+    def __init__(self, session, host, user=None, password=None, ssl=False, port=8440):
+        aiohttp = _aiohttp()
+        self.session = session
+        self.url = '{}://{}:{}/RPC2'.format('https' if ssl else 'http', host, port)
+        self.auth = aiohttp.BasicAuth(user, password) if user else None
+
+    async def call(self, method, params):
+        body = xmlrpc_client.dumps((params,), 'pem.{}'.format(method)).encode('utf-8')
+        async with self.session.post(self.url, data=body, auth=self.auth,
+                                     headers={'Content-Type': 'text/xml'}) as r:
+            r.raise_for_status()
+            content = await r.read()
+        # Faults are raised as xmlrpc.client.Fault, as with ServerProxy
+        (result,), _ = xmlrpc_client.loads(content)
+        return result
+
+
+class AsyncRPCProxy(object):
+    """Async counterpart of RPCProxy, `await hub.osaapi.aps.getApplicationInstances(app_id=1)`."""
+
+    def __init__(self, transport, name=None):
+        self._transport = transport
+        self._name = name
+
+    def __getattr__(self, attr):
+        if self._name is None:
+            attr = RPC_NAMESPACES.get(attr, attr)
+        name = '{}.{}'.format(self._name, attr) if self._name else attr
+        return AsyncRPCProxy(self._transport, name)
+
+    async def __call__(self, **kwargs):
+        await governor.acquire_async('rpc')
+        start = time.monotonic()
+        try:
+            r = await self._transport.call(self._name, kwargs)
+        except Exception:
+            governor.report('rpc', time.monotonic() - start, error=True)
+            progress.record_call(error=True)
+            raise
+        elapsed = time.monotonic() - start
+        failed = bool(r.get('status')) if isinstance(r, dict) else False
+        governor.report('rpc', elapsed, error=failed)
+        progress.record_call(error=failed)
+        stats.record('rpc', self._name, elapsed)
+        return r
+
+
+class AsyncHub(object):
+    """Asyncio counterpart of Hub, APS and XML-RPC calls share one aiohttp connection pool.
+
+        async with AsyncHub() as hub:
+            instances = await hub.get_application_instances(app_id)
+    """
+    session = None
+    osaapi = None
+    aps = None
+    hub_id = None
+
+    def __init__(self, pool_size=APS_POOL_SIZE):
+        config = get_config()
+        self._rpc_params = {k: config[k] for k in RPC_CONNECT_PARAMS}
+        self._aps_url = APS._get_aps_url(**{k: config[k] for k in APS_CONNECT_PARAMS})
+        self.pool_size = pool_size
+        self.tokens = AsyncTokenManager(self._fetch_token)
+
+    async def open(self):
+        aiohttp = _aiohttp()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0, limit_per_host=max(self.pool_size, 1)),
+        )
+        self.osaapi = AsyncRPCProxy(AsyncXMLRPC(self.session, **self._rpc_params))
+        self.aps = AsyncAPS(self.session, self.tokens.source('user', 1), self._aps_url)
+        self.hub_id = await self._get_id()
+        return self
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+    async def __aenter__(self):
+        try:
+            return await self.open()
+        except BaseException:
+            await self.close()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _fetch_token(self, kind, key):
+        if kind == 'application':
+            r = await self.osaapi.APS.getApplicationInstanceToken(application_instance_id=key)
+        else:
+            r = await self.osaapi.APS.getUserToken(user_id=key)
+        osaapi_raise_for_status(r)
+        return r['result']['aps_token']
+
+    async def _get_id(self):
+        rql = 'implementing(http://parallels.com/aps/types/pa/poa/1.0)'
+        try:
+            async for poa in self.aps.iter_resources(rql, page_size=1):
+                return poa['aps']['id']
+        except ValueError:
+            print("APSController provided non-json format")
+            sys.exit(1)
+        return None
+
+    async def get_admin_token(self):
+        return {'APS-Token': await self.tokens.get('user', 1)}
+
+    async def get_application_token(self, instance_id):
+        return {'APS-Token': await self.tokens.get('application', instance_id)}
+
+    async def get_applications(self, aps_application_id):
+        r = await self.osaapi.APS.getApplications(aps_application_id=aps_application_id)
+        osaapi_raise_for_status(r)
+        if len(r['result']) == 0:
+            return None
+        return r['result'][0]['application_id'] or None
+
+    async def get_application_instances(self, application_id):
+        r = await self.osaapi.aps.getApplicationInstances(app_id=application_id)
+        osaapi_raise_for_status(r)
+        return r['result']
+
+    async def get_application_instance(self, instance_id):
+        r = await self.osaapi.aps.getApplicationInstance(application_instance_id=instance_id)
+        osaapi_raise_for_status(r)
+        return r['result']
+
+    async def get_application_settings(self, instance_id):
+        r = await self.osaapi.aps.getApplicationInstanceSettings(application_instance_id=instance_id)
+        osaapi_raise_for_status(r)
+        return r['result']
+
+    async def get_instances_with_settings(self, application_id, need_settings=None, concurrency=RPC_WORKERS,
+                                          skip=None, setting_keys=None):
+        limit = asyncio.Semaphore(max(concurrency, 1))
+
+        async def fetch(inst):
+            instance_id = inst['application_instance_id']
+            async with limit:
+                if 'status' in inst and 'package_version' in inst:
+                    details = inst
+                else:
+                    details = await self.get_application_instance(instance_id)
+                settings = None
+                if need_settings is None or need_settings(details):
+                    settings = await self.get_application_settings(instance_id)
+            return InstanceRecord.from_rpc(instance_id, details, settings, setting_keys)
+
+        instances = await self.get_application_instances(application_id)
+        if skip:
+            instances = [inst for inst in instances if not skip(inst)]
+        return await asyncio.gather(*(fetch(inst) for inst in instances))
+
+
+class AsyncAPS(object):
+    """Asyncio counterpart of APS, responses are AsyncResponse objects."""
+
+    def __init__(self, session, token, url=None, retries=APS_RETRIES):
+        if not url:
+            config = get_config()
+            url = APS._get_aps_url(**{k: config[k] for k in APS_CONNECT_PARAMS})
+        self.session = session
+        self.token = token
+        self.url = url
+        self.retries = retries
+
+    async def find_in(self, implementing, prop, values, select=None, batch_size=APS_BATCH_SIZE):
+        values = list(values)
+        for start in range(0, len(values), batch_size):
+            batch = ','.join(str(v) for v in values[start:start + batch_size])
+            rql = 'implementing({}),in({},({}))'.format(implementing, prop, batch)
+            if select:
+                rql += ',select({})'.format(select)
+            async for resource in self.iter_resources(rql, page_size=batch_size):
+                yield resource
+
+    async def iter_resources(self, rql, page_size=APS_PAGE_SIZE, collection='aps/2/resources'):
+        offset = 0
+        while True:
+            query = ','.join(part for part in (rql, 'limit({},{})'.format(offset, page_size)) if part)
+            r = await self.get('{}?{}'.format(collection, query))
+            apsapi_raise_for_status(r)
+            total = content_range_total(r.headers.get('Content-Range'))
+            page = r.json()
+            del r
+            for resource in page:
+                yield resource
+            offset += len(page)
+            if len(page) < page_size or (total is not None and offset >= total):
+                return
+            if total is None and len(page) > page_size:
+                # Not a paged collection, limit() was ignored and the full listing came back
+                return
+
+    async def _request(self, method, uri, json=None, subscription=None):
+        token = await self.token()
+        r = await self._send(method, uri, token, json, subscription)
+        if r.status_code == 401:
+            r = await self._send(method, uri, await self.token(stale=token), json, subscription)
+        return r
+
+    async def _send(self, method, uri, token, json, subscription):
+        aiohttp = _aiohttp()
+        headers = {'APS-Token': token}
+        if subscription:
+            headers['APS-Subscription-ID'] = subscription
+        budget = aps_budget(method, uri)
+        # Same policy as APS._send: statuses are only retried for idempotent methods, and
+        # POST is only retried when the connection could not be opened
+        retry_errors = aiohttp.ClientConnectorError if method == 'POST' else aiohttp.ClientConnectionError
+        attempt = 0
+        while True:
+            await governor.acquire_async(budget)
+            start = time.monotonic()
+            try:
+                async with self.session.request(method, '{}/{}'.format(self.url, uri), headers=headers,
+                                                json=json, ssl=False) as r:
+                    content = await r.read()
+                    response = AsyncResponse(r.status, r.headers, content)
+            except retry_errors:
+                governor.report(budget, time.monotonic() - start, error=True)
+                progress.record_call(error=True)
+                if attempt >= self.retries:
+                    raise
+            except aiohttp.ClientError:
+                governor.report(budget, time.monotonic() - start, error=True)
+                progress.record_call(error=True)
+                raise
+            else:
+                elapsed = time.monotonic() - start
+                governor.report(budget, elapsed, response.status_code)
+                progress.record_call(response.status_code)
+                stats.record('aps', '{} {}'.format(method, endpoint_pattern(uri)), elapsed, len(content))
+                if (method == 'POST' or response.status_code not in APS_RETRY_STATUSES
+                        or attempt >= self.retries):
+                    return response
+            await asyncio.sleep(APS_RETRY_BACKOFF * (2 ** attempt))
+            attempt += 1
+
+    async def get(self, uri):
+        return await self._request('GET', uri)
+
+    async def post(self, uri, json=None, subscription=None):
+        return await self._request('POST', uri, json=json, subscription=subscription)
+
+    async def put(self, uri, json=None):
+        return await self._request('PUT', uri, json=json)
+
+    async def delete(self, uri):
+        return await self._request('DELETE', uri)
@@ -1,2 +1,5 @@
 BSS_SUBSCRIPTION = 'http://www.odin.com/billing/Subscription/1.0'
-OSS_SUBSCRIPTION = 'http://parallels.com/aps/types/pa/subscription/1.0'
\ No newline at end of file
+OSS_SUBSCRIPTION = 'http://parallels.com/aps/types/pa/subscription/1.0'
+BILLING_RESOURCE = 'http://www.odin.com/billing/Resource/1.3'
+APS_POOL_SIZE = 10
+RPC_WORKERS = 8
@@ -1,15 +1,32 @@
 import json
+import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from xml.etree import ElementTree as xml_et
 
 import osaapi
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 
 from aps1toconnect.config import get_config, CFG_FILE_PATH
+from aps1toconnect.constants import APS_POOL_SIZE, RPC_WORKERS
+from aps1toconnect.profiling import endpoint_pattern, stats
+from aps1toconnect.progress import progress
+from aps1toconnect.records import InstanceRecord
+from aps1toconnect.throttle import aps_budget, governor
+from aps1toconnect.tokens import TokenManager
 
 RPC_CONNECT_PARAMS = ('host', 'user', 'password', 'ssl', 'port')
 APS_CONNECT_PARAMS = ('aps_host', 'aps_port', 'use_tls_aps')
+APS_RETRIES = 3
+APS_RETRY_BACKOFF = 0.5
+APS_RETRY_STATUSES = (500, 502, 503, 504)
+APS_BATCH_SIZE = 100
+APS_PAGE_SIZE = 500
 
 
 def json_decode(content):
@@ -21,6 +38,28 @@ def json_decode(content):
     return json.loads(content)
 
 
+def connection_not_opened(error):
+    # Only a connection that could not be opened proves the hub never saw the request
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _retryable_error(method, error):
+    if method == 'POST':
+        return connection_not_opened(error)
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def content_range_total(content_range):
+    # APS answers paged queries with "Content-Range: items 0-99/1234"
+    if not content_range or '/' not in content_range:
+        return None
+    total = content_range.rsplit('/', 1)[1].strip()
+    return int(total) if total.isdigit() else None
+
+
 def osaapi_raise_for_status(r):
     if r['status']:
         if 'error_message' in r:
@@ -30,29 +69,68 @@ def osaapi_raise_for_status(r):
 
 
 def apsapi_raise_for_status(r):
+    # Also checks the AsyncResponse of async_hub, which only has the status, headers and body.
+    # Proxies and a hub under maintenance answer errors in plain text or HTML
+    if r.status_code < 400:
+        return
     try:
-        r.raise_for_status()
-    except Exception as e:
-        if 'error' in r.json():
-            err = "{} {}".format(r.json()['error'], r.json()['message'])
-        else:
-            err = str(e)
-        print("Hub APS API response {} code.\n"
-              "Error: {}".format(r.status_code, err))
-        sys.exit(1)
+        body = r.json()
+        err = "{} {}".format(body['error'], body['message'])
+    except (ValueError, KeyError, TypeError):
+        err = r.content.decode('utf-8', 'replace')
+    print("Hub APS API response {} code.\n"
+          "Error: {}".format(r.status_code, err))
+    sys.exit(1)
+
+class RPCProxy(object):
+    """Wraps an osaapi client so that every RPC method call is throttled and timed."""
+
+    def __init__(self, target, name=None):
+        self._target = target
+        self._name = name
+
+    def __getattr__(self, attr):
+        name = '{}.{}'.format(self._name, attr) if self._name else attr
+        return RPCProxy(getattr(self._target, attr), name)
+
+    def __call__(self, *args, **kwargs):
+        governor.acquire('rpc')
+        start = time.monotonic()
+        try:
+            r = self._target(*args, **kwargs)
+        except Exception:
+            governor.report('rpc', time.monotonic() - start, error=True)
+            progress.record_call(error=True)
+            raise
+        elapsed = time.monotonic() - start
+        failed = bool(r.get('status')) if isinstance(r, dict) else False
+        governor.report('rpc', elapsed, error=failed)
+        progress.record_call(error=failed)
+        stats.record('rpc', self._name, elapsed)
+        return r
+
 
 class Hub(object):
-    osaapi = None
     aps = None
     hub_id = None
     extension_id = None
 
-    def __init__(self):
+    def __init__(self, pool_size=APS_POOL_SIZE):
         config = get_config()
-        self.osaapi = osaapi.OSA(**{k: config[k] for k in RPC_CONNECT_PARAMS})
-        self.aps = APS(self.get_admin_token())
+        self._rpc_params = {k: config[k] for k in RPC_CONNECT_PARAMS}
+        self._local = threading.local()
+        self.tokens = TokenManager(self._fetch_token)
+        self.aps = APS(self.tokens.source('user', 1), pool_size=pool_size)
         self.hub_id = self._get_id()
 
+    @property
+    def osaapi(self):
+        # xmlrpc ServerProxy keeps a single connection and is not thread safe,
+        # so every thread talks to the hub through its own client
+        if getattr(self._local, 'osaapi', None) is None:
+            self._local.osaapi = RPCProxy(osaapi.OSA(**self._rpc_params))
+        return self._local.osaapi
+
     @staticmethod
     def configure(hub_host, user='admin', pwd='1q2w3e', use_tls=False, port=8440, aps_host=None,
                   aps_port=6308, use_tls_aps=True):
@@ -64,7 +142,7 @@ class Hub(object):
             hub_version = Hub._get_hub_version(hub)
             print("Connectivity with Hub RPC API [ok]")
             aps_url = '{}://{}:{}'.format('https' if use_tls_aps else 'http', aps_host, aps_port)
-            aps = APS(Hub._get_user_token(hub, 1), aps_url)
+            aps = APS(lambda stale=None: Hub._get_user_token(hub, 1)['APS-Token'], aps_url)
             response = aps.get('aps/2/applications/')
             response.raise_for_status()
             print("Connectivity with Hub APS API [ok]")
@@ -74,6 +152,8 @@ class Hub(object):
             sys.exit(1)
 
         else:
+            if not os.path.exists(os.path.dirname(CFG_FILE_PATH)):
+                os.makedirs(os.path.dirname(CFG_FILE_PATH))
             with open(CFG_FILE_PATH, 'w+') as cfg:
                 cfg.write(json.dumps({'host': hub_host, 'user': user, 'password': pwd,
                                       'ssl': use_tls, 'port': port, 'aps_port': aps_port,
@@ -101,18 +181,20 @@ class Hub(object):
         osaapi_raise_for_status(r)
         return {'APS-Token': r['result']['aps_token']}
 
-    def _get_id(self):
-        url = 'aps/2/resources?implementing(http://parallels.com/aps/types/pa/poa/1.0)'
-        r = self.aps.get(url)
-        r.raise_for_status()
+    def _fetch_token(self, kind, key):
+        if kind == 'application':
+            return Hub._get_application_token(self.osaapi, key)['APS-Token']
+        return Hub._get_user_token(self.osaapi, key)['APS-Token']
 
+    def _get_id(self):
+        rql = 'implementing(http://parallels.com/aps/types/pa/poa/1.0)'
         try:
-            data = json_decode(r.content)
+            poa = next(self.aps.iter_resources(rql, page_size=1), None)
         except ValueError:
             print("APSController provided non-json format")
             sys.exit(1)
         else:
-            return data[0]['aps']['id'] if data else None
+            return poa['aps']['id'] if poa else None
 
     @staticmethod
     def _get_resclass_name(unit):
@@ -129,7 +211,10 @@ class Hub(object):
         return resclass_name or 'rc.saas.resource.unit'
 
     def get_admin_token(self):
-        return Hub._get_user_token(self.osaapi, 1)
+        return {'APS-Token': self.tokens.get('user', 1)}
+
+    def get_application_token(self, instance_id):
+        return {'APS-Token': self.tokens.get('application', instance_id)}
 
     def get_application_id(self, package_id):
         payload = {
@@ -169,6 +254,25 @@ class Hub(object):
         osaapi_raise_for_status(r)
         return r['result']
 
+    def get_instances_with_settings(self, application_id, need_settings=None, workers=RPC_WORKERS,
+                                    skip=None, setting_keys=None):
+        def fetch(inst):
+            instance_id = inst['application_instance_id']
+            if 'status' in inst and 'package_version' in inst:
+                details = inst
+            else:
+                details = self.get_application_instance(instance_id)
+            settings = None
+            if need_settings is None or need_settings(details):
+                settings = self.get_application_settings(instance_id)
+            return InstanceRecord.from_rpc(instance_id, details, settings, setting_keys)
+
+        instances = self.get_application_instances(application_id)
+        if skip:
+            instances = [inst for inst in instances if not skip(inst)]
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            return list(executor.map(fetch, instances))
+
     def get_applications(self, aps_application_id):
         payload = {
             'aps_application_id': aps_application_id
@@ -186,32 +290,122 @@ class Hub(object):
 class APS(object):
     url = None
     token = None
+    session = None
 
-    def __init__(self, token, url=None):
+    def __init__(self, token, url=None, pool_size=APS_POOL_SIZE, retries=APS_RETRIES):
         if url:
             self.url = url
         else:
             config = get_config()
             self.url = APS._get_aps_url(**{k: config[k] for k in APS_CONNECT_PARAMS})
         self.token = token
+        self.retries = retries
+        self.session = APS._get_session(pool_size)
 
     @staticmethod
     def _get_aps_url(aps_host, aps_port, use_tls_aps):
         return '{}://{}:{}'.format('https' if use_tls_aps else 'http', aps_host, aps_port)
 
+    @staticmethod
+    def _get_session(pool_size):
+        # No urllib3 retries, _send retries so every attempt goes through the governor
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+        session = requests.Session()
+        session.verify = False
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def connection_stats(self):
+        connections, calls = 0, 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool:
+                    connections += pool.num_connections
+                    calls += pool.num_requests
+        return connections, calls
+
+    def log_stats(self):
+        connections, calls = self.connection_stats()
+        reused = calls - connections if calls > connections else 0
+        print("Hub APS API: {} requests over {} connections ({} reused)".format(
+            calls, connections, reused))
+
+    def find_in(self, implementing, prop, values, select=None, batch_size=APS_BATCH_SIZE):
+        values = list(values)
+        for start in range(0, len(values), batch_size):
+            batch = ','.join(str(v) for v in values[start:start + batch_size])
+            rql = 'implementing({}),in({},({}))'.format(implementing, prop, batch)
+            if select:
+                rql += ',select({})'.format(select)
+            for resource in self.iter_resources(rql, page_size=batch_size):
+                yield resource
+
+    def iter_resources(self, rql, page_size=APS_PAGE_SIZE, collection='aps/2/resources'):
+        offset = 0
+        while True:
+            query = ','.join(part for part in (rql, 'limit({},{})'.format(offset, page_size)) if part)
+            r = self.get('{}?{}'.format(collection, query))
+            apsapi_raise_for_status(r)
+            total = content_range_total(r.headers.get('Content-Range'))
+            page = json_decode(r.content)
+            # Only the current page is held, records are handed out as soon as it is decoded
+            del r
+            for resource in page:
+                yield resource
+            offset += len(page)
+            if len(page) < page_size or (total is not None and offset >= total):
+                return
+            if total is None and len(page) > page_size:
+                # Not a paged collection, limit() was ignored and the full listing came back
+                return
+
+    def _request(self, method, uri, json=None, subscription=None):
+        token = self.token()
+        r = self._send(method, uri, token, json, subscription)
+        if r.status_code == 401:
+            r = self._send(method, uri, self.token(stale=token), json, subscription)
+        return r
+
+    def _send(self, method, uri, token, json, subscription):
+        headers = {'APS-Token': token}
+        if subscription:
+            headers['APS-Subscription-ID'] = subscription
+        budget = aps_budget(method, uri)
+        attempt = 0
+        while True:
+            governor.acquire(budget)
+            start = time.monotonic()
+            try:
+                r = self.session.request(method, '{}/{}'.format(self.url, uri), headers=headers,
+                                         json=json)
+            except requests.RequestException as e:
+                governor.report(budget, time.monotonic() - start, error=True)
+                progress.record_call(error=True)
+                if attempt >= self.retries or not _retryable_error(method, e):
+                    raise
+            else:
+                elapsed = time.monotonic() - start
+                governor.report(budget, elapsed, r.status_code)
+                progress.record_call(r.status_code)
+                stats.record('aps', '{} {}'.format(method, endpoint_pattern(uri)), elapsed,
+                             len(r.content or b''))
+                # Order placement is not idempotent, statuses are only retried for the other methods
+                if method == 'POST' or r.status_code not in APS_RETRY_STATUSES or attempt >= self.retries:
+                    return r
+            time.sleep(APS_RETRY_BACKOFF * (2 ** attempt))
+            attempt += 1
+
     def get(self, uri):
-        return requests.get('{}/{}'.format(self.url, uri), headers=self.token, verify=False)
+        return self._request('GET', uri)
 
     def post(self, uri, json=None, subscription=None):
-        headers = self.token
-        if subscription:
-            headers['APS-Subscription-ID'] = subscription
-        return requests.post('{}/{}'.format(self.url, uri), headers=headers, json=json,
-                             verify=False)
+        return self._request('POST', uri, json=json, subscription=subscription)
 
     def put(self, uri, json=None):
-        return requests.put('{}/{}'.format(self.url, uri), headers=self.token, json=json,
-                            verify=False)
+        return self._request('PUT', uri, json=json)
 
     def delete(self, uri):
-        return requests.delete('{}/{}'.format(self.url, uri), headers=self.token, verify=False)
+        return self._request('DELETE', uri)
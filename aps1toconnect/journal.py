@@ -0,0 +1,60 @@
+import json
+import os
+import threading
+import time
+
+STAGES = ('validated', 'order_placed', 'order_completed', 'tenant_activated', 'connect_approved')
+JOURNAL_SYNC_EVERY = 50
+
+
+def stage_reached(stage, target):
+    return stage is not None and STAGES.index(stage) >= STAGES.index(target)
+
+
+class Journal(object):
+    """Append-only JSON lines log of the stage reached by every instance."""
+
+    def __init__(self, path, sync_every=JOURNAL_SYNC_EVERY):
+        self.path = path
+        self.sync_every = sync_every
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+        self._unsynced = 0
+
+    @staticmethod
+    def load(path):
+        states = {}
+        if not os.path.exists(path):
+            return states
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line may be truncated if the previous run was killed mid write
+                    continue
+                state = states.setdefault(entry.pop('instance'), {})
+                entry.pop('time', None)
+                state.update(entry)
+        return states
+
+    def record(self, instance_id, stage, sync=False, **data):
+        entry = dict(data, instance=instance_id, stage=stage, time=time.time())
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._unsynced += 1
+            if sync or self._unsynced >= self.sync_every:
+                self._sync()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        self.sync()
+        self._file.close()
@@ -1,185 +1,835 @@
+import csv
+import hashlib
 import json
 import os
 import sys
-import uuid
+import threading
+import time
 import warnings
 import traceback
-from distutils.util import strtobool
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
-import fire
-import pkg_resources
-from requests import get
-from six.moves import input
-
-from aps1toconnect.action_logger import Logger
+from aps1toconnect.action_logger import (
+    Logger, begin_block, end_block, flush_logs, set_context, enable_structured_log, log_event
+)
+from aps1toconnect.cache import TTLCache
 from aps1toconnect.config import CFG_FILE_PATH, NULL_CFG_INFO
-from aps1toconnect.hub import Hub
+from aps1toconnect.constants import APS_POOL_SIZE, RPC_WORKERS
+from aps1toconnect.journal import Journal, stage_reached
 from aps1toconnect.migration_config import get_config
+from aps1toconnect.orders import ORDER_COMPLETED, ORDER_POLL_WORKERS, OrderPoller
+from aps1toconnect.policy import Policy, RetryQueue
+from aps1toconnect.profiling import stats
+from aps1toconnect.progress import PROGRESS_INTERVAL, progress
+from aps1toconnect.sharding import Partition, shard_key, shard_of, shard_path
+from aps1toconnect.snapshot import Snapshot
+from aps1toconnect.throttle import governor
 from aps1toconnect import constants
-from connect.client import ConnectClient, ClientError, R
-LOG_DIR = os.path.expanduser('~/.connect')
 
-if not os.path.exists(LOG_DIR):
-    os.makedirs(LOG_DIR)
+# osaapi, requests, connect.client and fire take most of the startup time, they are
+# imported by the commands that talk to the hub or Connect and by main()
 
+LOG_DIR = os.path.expanduser('~/.connect')
 LOG_FILE = os.path.join(LOG_DIR, "migration.log")
-
-sys.stdout = Logger(LOG_FILE, sys.stdout)
-sys.stdout.isatty = lambda: False
-sys.stderr = Logger(LOG_FILE, sys.stderr)
+STRUCTURED_LOG_FILE = os.path.join(LOG_DIR, "migration.jsonl")
+MAPPING_CACHE_FILE = os.path.join(LOG_DIR, "mapping_cache.json")
+JOURNAL_FILE = os.path.join(LOG_DIR, "migration_journal.jsonl")
+PLAN_FILE = os.path.join(LOG_DIR, "migration_plan.json")
+SNAPSHOT_FILE = os.path.join(LOG_DIR, "instance_snapshot.json")
+TENANT_LEDGER_FILE = os.path.join(LOG_DIR, "tenant_ledger.jsonl")
+STATUS_FILE = os.path.join(LOG_DIR, "migration_status.json")
+RETRY_QUEUE_FILE = os.path.join(LOG_DIR, "retry_queue.json")
+PARTITION_FILE = os.path.join(LOG_DIR, "migration_partition.json")
+PROFILE_FILE = os.path.join(LOG_DIR, "migration_profile.json")
 
 warnings.filterwarnings('ignore')
 
-IS_PYTHON3 = sys.version_info >= (3,)
+PLAN_CACHE_SIZE = 256
+PLAN_CACHE_TTL = 3600
+# A seeded plan carries the resource amounts read when it was made
+PLAN_MAX_AGE = 24 * 3600
+
+PLAN_CSV_COLUMNS = ('instance_id', 'subscription', 'status', 'failure', 'message', 'plan_id', 'resources')
+# Failures that only depend on the instance itself, they stay valid until the instance changes
+SETTLED_FAILURES = ('not_ready', 'wrong_version')
 
 
 class Migrator:
     def init_hub(self, hub_host, user='admin', pwd='1q2w3e', use_tls=False, port=8440,
                  aps_host=None, aps_port=6308, use_tls_aps=True):
         """ Connect your CloudBlue Commerce Instance (Hub)"""
+        from aps1toconnect.hub import Hub
+
         Hub.configure(hub_host, user, pwd, use_tls, port, aps_host, aps_port, use_tls_aps)
 
     def info(self):
         """ Show current state of migration binding with OA Hub"""
         print("OA Hub:")
-        print(_check_binding(lambda: os.path.exists(CFG_FILE_PATH), _get_hub_info))
+        print(_check_binding(_get_hub_info))
 
     def hub_token(self):
         """ Provides the ID of the Commerce Installation """
-        hub = Hub()
-        print(hub.hub_id)
-
-    def initiate_migration(self):
-        """ Starts migration process"""
-        migration_config = get_config()
-        hub = Hub()
-        print("Migration config ok")
-        mappings = _load_mappings(migration_config['RESOURCE_MAPPING'], hub.aps)
-        app_instance_id = hub.get_applications(migration_config['APP_APP_ID'])
-        if not app_instance_id:
-            print(f"Application for {migration_config['APP_APP_ID']} not found in the hub")
+        from aps1toconnect.hub import Hub
+
+        print(Hub().hub_id)
+
+    def initiate_migration(self, workers=1, plan_file=None, profile_file=None, incremental=False):
+        """ Starts migration process, handling up to `workers` instances concurrently"""
+        _init_output()
+        _migrate(workers, plan_file=plan_file, incremental=incremental)
+        _report_profile(profile_file)
+
+    def resume(self, workers=1, plan_file=None, profile_file=None):
+        """ Resumes an interrupted migration, skipping work recorded in the journal"""
+        _init_output()
+        _migrate(workers, resume=True, plan_file=plan_file)
+        _report_profile(profile_file)
+
+    def retry(self, workers=1, profile_file=None):
+        """ Migrates again the instances skipped by the policy and kept in the retry queue"""
+        _init_output()
+        _migrate(workers, resume=True, retry=True)
+        _report_profile(profile_file)
+
+    def plan(self, output=PLAN_FILE, workers=RPC_WORKERS, profile_file=None):
+        """ Computes every change order without placing them and writes a JSON or CSV report"""
+        _init_output()
+        _plan(output, workers)
+        _report_profile(profile_file)
+
+    def partition(self, shards, output=PARTITION_FILE, workers=RPC_WORKERS):
+        """ Splits the instances into `shards` work partitions, one per worker process"""
+        _init_output()
+        _partition(shards, output, workers)
+
+    def shard(self, index, partition_file=PARTITION_FILE, workers=1, resume=False, retry=False):
+        """ Migrates the instances of one work partition, with its own journal and log"""
+        partition = _load_partition(partition_file)
+        if not 0 <= index < partition.shards:
+            print(f"Shard {index} does not exist, the partition has {partition.shards} shards")
             sys.exit(1)
-        instances = hub.get_application_instances(app_instance_id)
-        if len(instances) == 0:
-            print("Nothing to migrate")
-            sys.exit(1)
-        print(f"Found {len(instances)} instances of application {migration_config['APP_APP_ID']}")
-        for inst in instances:
-            instance_details = hub.get_application_instance(inst['application_instance_id'])
-            if instance_details.get('status') != 'Ready':
-                print(f"Instance {inst['application_instance_id']} is not in Ready status, skipping")
-                _confirm("Do you want to try with next? [y/n]")
-                continue
-            if instance_details.get('package_version') != migration_config['APP_SAFE_DELETE_VERSION']:
-                print(f"Instance {inst['application_instance_id']} is not in proper version for safe upgrade")
-                _confirm("Do you want to try with next? [y/n]")
-                continue
-            settings = hub.get_application_settings(inst['application_instance_id'])
-            subscription = _setting_from_settings(settings, migration_config['SUBSCRIPTION_ID_SETTING'])
-            activation_params = _populate_params(settings, migration_config['PARAMS_MAPPING'])
-            if not subscription:
-                print(f"Instance {inst['application_instance_id']} has no setting for "
-                      f"{migration_config['SUBSCRIPTION_ID_SETTING']} and due it can't "
-                      f"be discovered the subscription"
-                      )
-                exit(1)
-            print(f"Instance {inst['application_instance_id']} is from subscription {subscription}")
-            bss_subscriptions = hub.aps.get(
-                f'aps/2/resources?implementing({constants.BSS_SUBSCRIPTION}),eq(subscriptionId,{subscription}),select(servicePlan,account)'
-            ).json()
-            bss_subscription = bss_subscriptions[0]
-            if bss_subscription['status'] != 'ACTIVE':
-                print(
-                    f"Subscription {subscription} is not active, is in status {bss_subscription['status']} "
-                    "and due it can't be migrated"
-                )
-                _confirm("Do you want to try with next? [y/n]")
-                continue
-            period_switches = hub.aps.post(
-                f'aps/2/resources/{bss_subscription["servicePlan"]["aps"]["id"]}/planPeriodSwitches',
-                json=bss_subscription['subscriptionPeriod']
-            ).json()
-
-            if _potential_plans(period_switches) != 2:
-                print(
-                    f"Source plan for subscription {subscription} has more than one upgrade path,"
-                    f"Is not possible to migrate."
-                )
-                exit(1)
-            new_plan = _select_new_plan(bss_subscription["servicePlan"]["aps"]["id"], period_switches)
-            resources = hub.aps.get(f'aps/2/resources/{bss_subscription["aps"]["id"]}/resources').json()
-            new_plan_data = hub.aps.get(f'aps/2/resources/{new_plan}').json()
-            if not new_plan_data:
-                print("Error obtaining new plan")
-                exit(1)
-
-            order = {
-                "type": "CHANGE",
-                "subscriptionId": bss_subscription['aps']['id'],
-                "period": bss_subscription['subscriptionPeriod'],
-                "planId": new_plan,
-                "resources": []
-            }
-
-            for resource in resources:
-                if not resource['resourceId'] in mappings:
-                    print(f"Resource {resource['id']} not present in mappings! unsure what to do")
-                    exit(1)
-                new_resource_id = ""
-                for new_resource in new_plan_data['resourceRates']:
-                    if new_resource['resourceId'] in mappings[resource['resourceId']]:
-                        new_resource_id = new_resource['resourceId']
-                order['resources'].append({
-                    "resourceId": new_resource_id,
-                    "amount": int(resource['included'] + resource['additional'])
-                })
-            print(f"Change order with following data: {order}")
-            change_order = hub.aps.post('/aps/2/services/order-manager/orders', json=order).json()
-            print(f"Order created {change_order}")
-            oa_subscription = hub.aps.get(
-                f'aps/2/resources?implementing({constants.OSS_SUBSCRIPTION}),eq(subscriptionId,{subscription})'
-            ).json()
-            tenant = _get_new_tenant(activation_params, migration_config['CONNECT_PRODUCT_ID'])
-            print(f"The tenant to be activated: {json.dumps(tenant)}")
-            while not _is_order_ready(change_order['orderId'], hub.aps):
-                print("Order provisioning did not finished")
-                _confirm("Let's wait? [y/n]")
-            activation = hub.aps.post('aps/2/resources', json=tenant, subscription=oa_subscription[0]['aps']['id'])
-            print(f"Result of activation resource: {activation.json()}")
-            connect_client = ConnectClient(
-                api_key=migration_config['CONNECT_API_KEY'],
-                endpoint=migration_config['CONNECT_API_ENDPOINT'],
+        _init_output(shard_path(LOG_FILE, index))
+        _migrate(workers, resume=resume or retry, retry=retry, partition=partition, shard=index)
+        _report_profile(shard_path(PROFILE_FILE, index), samples=True)
+
+    def merge_report(self, partition_file=PARTITION_FILE, directory=LOG_DIR, profile_file=None):
+        """ Combines the outcome and timing stats of every shard found in `directory`"""
+        _init_output()
+        _merge_report(_load_partition(partition_file), directory)
+        _report_profile(profile_file)
+
+
+# Only the commands that work on the migration write its log, info and hub-token leave stdout alone
+def _init_output(log_file=LOG_FILE):
+    if not os.path.exists(LOG_DIR):
+        os.makedirs(LOG_DIR)
+    Logger(log_file).log("=============================\n{}\n".format(" ".join(sys.argv)))
+    sys.stdout = Logger(log_file, getattr(sys.stdout, 'terminal', sys.stdout))
+    sys.stdout.isatty = lambda: False
+    sys.stderr = Logger(log_file, getattr(sys.stderr, 'terminal', sys.stderr))
+
+
+def _report_profile(profile_file, samples=False):
+    governor.log_state()
+    stats.print_summary()
+    if profile_file:
+        stats.export(profile_file, samples=samples)
+        print(f"Run profile saved [{profile_file}]")
+
+
+def _prepare(workers, skip=None, snapshot=None, structured_log=STRUCTURED_LOG_FILE):
+    from aps1toconnect.hub import Hub
+
+    migration_config = get_config()
+    if migration_config.get('STRUCTURED_LOG'):
+        enable_structured_log(structured_log)
+    governor.configure(migration_config.get('RATE_LIMITS'))
+    hub = Hub(pool_size=_aps_pool_size(workers, migration_config))
+    print("Migration config ok")
+    mappings = _load_mappings(
+        migration_config['RESOURCE_MAPPING'],
+        hub.aps,
+        hub_id=hub.hub_id,
+        use_cache=migration_config.get('RESOURCE_MAPPING_CACHE', False),
+    )
+    app_instance_id = hub.get_applications(migration_config['APP_APP_ID'])
+    if not app_instance_id:
+        print(f"Application for {migration_config['APP_APP_ID']} not found in the hub")
+        sys.exit(1)
+    records = hub.get_instances_with_settings(
+        app_instance_id,
+        need_settings=lambda details: _is_upgradable(details, migration_config),
+        workers=max(workers, RPC_WORKERS),
+        skip=skip,
+        setting_keys=set(migration_config['PARAMS_MAPPING']) | {migration_config['SUBSCRIPTION_ID_SETTING']},
+    )
+    if snapshot is not None:
+        records = [record for record in records if snapshot.changed(record)]
+        if len(records) == 0:
+            print("No instance changed since the last run")
+            sys.exit(0)
+        print(f"{len(records)} instances are new or changed since the last run")
+    if len(records) == 0:
+        print("Nothing to migrate")
+        sys.exit(1)
+    print(f"Found {len(records)} instances of application {migration_config['APP_APP_ID']}")
+    for record in records:
+        record.subscription = record.setting(migration_config['SUBSCRIPTION_ID_SETTING'])
+    return hub, migration_config, mappings, records
+
+
+def _aps_pool_size(workers, migration_config):
+    # Pipeline workers, tenant activators and order pollers all share the APS session
+    from aps1toconnect.activation import TENANT_ACTIVATION_WORKERS
+
+    activators = migration_config.get('TENANT_ACTIVATION', {}).get('workers', TENANT_ACTIVATION_WORKERS)
+    pollers = migration_config.get('ORDER_POLL', {}).get('workers', ORDER_POLL_WORKERS)
+    return max(workers + activators + pollers, APS_POOL_SIZE)
+
+
+def _migrate(workers, resume=False, plan_file=None, incremental=False, retry=False, partition=None, shard=None):
+    journal_file, snapshot_file, structured_log = JOURNAL_FILE, SNAPSHOT_FILE, STRUCTURED_LOG_FILE
+    ledger_file, status_file, queue_file = TENANT_LEDGER_FILE, STATUS_FILE, RETRY_QUEUE_FILE
+    if partition:
+        journal_file = shard_path(JOURNAL_FILE, shard)
+        ledger_file = shard_path(TENANT_LEDGER_FILE, shard)
+        status_file = shard_path(STATUS_FILE, shard)
+        queue_file = shard_path(RETRY_QUEUE_FILE, shard)
+        snapshot_file = shard_path(SNAPSHOT_FILE, shard)
+        structured_log = shard_path(STRUCTURED_LOG_FILE, shard)
+        print(f"Running shard {shard} of {partition.shards}, {partition.sizes()[shard]} instances assigned")
+    # Loaded on every run: an instance with an order placed is only ever resumed, a
+    # second change order for its subscription must never be placed
+    previous = Journal.load(journal_file)
+    snapshot = Snapshot.load(snapshot_file)
+    if incremental:
+        print(f"Incremental run against a snapshot of {len(snapshot)} instances")
+    retry_queue = RetryQueue.load(queue_file)
+    if retry:
+        if not retry_queue:
+            print("Retry queue is empty, nothing to migrate")
+            return
+        print(f"Retrying {len(retry_queue)} instances of the retry queue")
+
+    def skip(inst):
+        if retry and inst['application_instance_id'] not in retry_queue:
+            return True
+        if previous.get(inst['application_instance_id'], {}).get('stage') == 'connect_approved':
+            return True
+        return incremental and snapshot.unchanged_listing(inst)
+
+    hub, migration_config, mappings, records = _prepare(
+        workers, skip=skip, snapshot=snapshot if incremental else None, structured_log=structured_log
+    )
+    planned = _load_plan(
+        plan_file, hub.hub_id, migration_config.get('PLAN_MAX_AGE', PLAN_MAX_AGE)
+    ) if plan_file else {}
+    if partition:
+        records = _own_records(records, partition, shard)
+    if resume:
+        print(f"Resuming migration, {len(records)} instances left")
+    # Planned instances too, the subscription may have been suspended since the plan was made
+    subscriptions = _prefetch_subscriptions(
+        hub.aps, [record.subscription for record in records if record.subscription],
+    )
+    run = MigrationRun(hub, migration_config, mappings, subscriptions)
+    run.snapshot = snapshot
+    run.retry_queue = retry_queue
+    run.start(Journal(journal_file), previous, planned, ledger_file)
+    _start_progress(len(records), migration_config, status_file)
+    try:
+        _run_pipeline(records, lambda record: _migrate_instance(run, record), workers)
+    finally:
+        progress.stop()
+        run.close()
+        snapshot.save(snapshot_file)
+        retry_queue.save(queue_file)
+        if retry_queue:
+            print(f"{len(retry_queue)} instances are in the retry queue {queue_file}, "
+                  "run retry to migrate them")
+    hub.aps.log_stats()
+    run.plan_cache.log_stats()
+
+
+def _start_progress(total, migration_config, status_file):
+    options = migration_config.get('PROGRESS', {})
+    progress.start(
+        total,
+        status_file=options.get('status_file', status_file),
+        metrics_file=options.get('metrics_file'),
+        metrics_port=options.get('metrics_port'),
+        interval=options.get('interval', PROGRESS_INTERVAL),
+        terminal=options.get('terminal', True),
+    )
+
+
+def _plan(output, workers):
+    hub, migration_config, mappings, records = _prepare(workers)
+    subscriptions = _prefetch_subscriptions(
+        hub.aps,
+        [record.subscription for record in records if record.subscription],
+    )
+    run = MigrationRun(hub, migration_config, mappings, subscriptions)
+
+    def plan_instance(record):
+        entry = {'instance_id': record.instance_id, 'subscription': record.subscription}
+        try:
+            entry.update(_plan_instance(run, record), status='planned')
+        except CheckFailed as e:
+            entry.update(status='skipped', failure=e.failure, message=e.message)
+        return entry
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        entries = list(executor.map(plan_instance, records))
+    _write_plan(entries, output, hub.hub_id)
+    summary = Counter(entry.get('failure', 'planned') for entry in entries)
+    for outcome, count in sorted(summary.items()):
+        print(f"{outcome}: {count}")
+    print(f"Migration plan for {len(entries)} instances saved [{output}]")
+    hub.aps.log_stats()
+    run.plan_cache.log_stats()
+
+
+def _partition(shards, output, workers):
+    if shards < 1:
+        print("At least one shard is needed")
+        sys.exit(1)
+    hub, migration_config, mappings, records = _prepare(workers)
+    partition = Partition.build(records, shards)
+    partition.save(output)
+    for index, size in enumerate(partition.sizes()):
+        print(f"Shard {index}: {size} instances")
+    print(f"Work partition for {len(records)} instances saved [{output}]")
+
+
+def _load_partition(partition_file):
+    try:
+        return Partition.load(partition_file)
+    except (IOError, ValueError, KeyError) as e:
+        print(f"Could not read work partition {partition_file}: {e}")
+        sys.exit(1)
+
+
+def _own_records(records, partition, shard):
+    # Ownership is decided here and not on the listing: settings, and with them the
+    # subscription, may have changed or been unknown when the partition was built. The
+    # shard of the subscription at order time keeps two workers off the same subscription
+    owned = []
+    for record in records:
+        if shard_of(shard_key(record), partition.shards) != shard:
+            continue
+        assigned = partition.shard_of_instance(record.instance_id)
+        if assigned is None:
+            print(f"Instance {record.instance_id} is not in the work partition, assigned to this "
+                  f"shard by its subscription; run partition again to rebalance")
+        elif assigned != shard:
+            print(f"Instance {record.instance_id} now belongs to subscription {record.subscription} "
+                  f"of this shard, it was assigned to shard {assigned}")
+        owned.append(record)
+    return owned
+
+
+def _merge_report(partition, directory):
+    outcomes = Counter()
+    journals = [Journal.load(shard_path(JOURNAL_FILE, index, directory)) for index in range(partition.shards)]
+    # Shards also migrate instances moved from another shard or missing from the partition
+    started = {str(instance_id) for states in journals for instance_id in states}
+    print("{:>5} {:>9} {:>10} {}".format('shard', 'assigned', 'completed', 'stages'))
+    for index, size in enumerate(partition.sizes()):
+        states = journals[index]
+        stages = Counter(state.get('stage') for state in states.values())
+        stages['not_started'] = sum(
+            1 for instance_id, assigned in partition.assignments.items()
+            if assigned == index and instance_id not in started
+        )
+        outcomes.update(stages)
+        print("{:>5} {:>9} {:>10} {}".format(
+            index, size, stages['connect_approved'],
+            ', '.join(f"{stage}: {count}" for stage, count in sorted(stages.items()) if count)))
+        profile = shard_path(PROFILE_FILE, index, directory)
+        if os.path.exists(profile):
+            stats.merge(profile)
+        else:
+            print(f"No run profile for shard {index} [{profile}]")
+    for stage, count in sorted(outcomes.items()):
+        if count:
+            print(f"{stage}: {count}")
+
+
+def _write_plan(entries, output, hub_id):
+    with open(output, 'w', newline='') as f:
+        if not output.endswith('.csv'):
+            json.dump({'hub_id': hub_id, 'generated_at': time.time(), 'entries': entries}, f, indent=4)
+            return
+        writer = csv.writer(f)
+        writer.writerow(PLAN_CSV_COLUMNS)
+        for entry in entries:
+            order = entry.get('order') or {}
+            writer.writerow([
+                entry['instance_id'],
+                entry['subscription'] or '',
+                entry['status'],
+                entry.get('failure', ''),
+                entry.get('message', ''),
+                order.get('planId', ''),
+                json.dumps(order.get('resources', [])) if order else '',
+            ])
+
+
+def _load_plan(plan_file, hub_id, max_age):
+    try:
+        with open(plan_file) as f:
+            plan = json.load(f)
+        plan_hub, generated_at, entries = plan['hub_id'], plan['generated_at'], plan['entries']
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        print(f"Could not read migration plan {plan_file}: {e}, generate it again with plan")
+        sys.exit(1)
+    if plan_hub != hub_id:
+        print(f"Migration plan {plan_file} was made for hub {plan_hub}, not for this hub {hub_id}")
+        sys.exit(1)
+    age = time.time() - generated_at
+    if age > max_age:
+        print(f"Migration plan {plan_file} is {int(age // 60)} minutes old, older than the "
+              f"{int(max_age // 60)} minutes allowed by PLAN_MAX_AGE, generate it again with plan")
+        sys.exit(1)
+    return {entry['instance_id']: entry for entry in entries if entry['status'] == 'planned'}
+
+
+class MigrationRun(object):
+    journal = None
+    snapshot = None
+    retry_queue = None
+    order_poller = None
+    activator = None
+    purchase_requests = None
+
+    def __init__(self, hub, migration_config, mappings, subscriptions):
+        self.hub = hub
+        self.config = migration_config
+        self.mappings = mappings
+        self.subscriptions = subscriptions
+        self.policy = Policy.from_config(migration_config)
+        self.previous = {}
+        self.planned = {}
+        self.stage_marks = {}
+        self.plan_cache = TTLCache(
+            'Plan cache',
+            maxsize=migration_config.get('PLAN_CACHE_SIZE', PLAN_CACHE_SIZE),
+            ttl=migration_config.get('PLAN_CACHE_TTL', PLAN_CACHE_TTL),
+        )
+
+    def start(self, journal, previous, planned, ledger_file=TENANT_LEDGER_FILE):
+        from connect.client import ConnectClient
+        from aps1toconnect.activation import TenantActivator
+        from aps1toconnect.purchase_requests import PurchaseRequestApprover
+
+        self.journal = journal
+        self.previous = previous
+        self.planned = planned
+        config = self.policy.component_config(self.config)
+        self.order_poller = OrderPoller.from_config(self.hub.aps, config)
+        self.activator = TenantActivator.from_config(
+            self.hub.aps, config, Journal(ledger_file), created=Journal.load(ledger_file),
+        )
+        self.purchase_requests = PurchaseRequestApprover.from_config(
+            ConnectClient(
+                api_key=self.config['CONNECT_API_KEY'],
+                endpoint=self.config['CONNECT_API_ENDPOINT'],
                 use_specs=False,
+            ),
+            config,
+        )
+
+    def close(self):
+        self.order_poller.stop()
+        self.activator.stop()
+        self.purchase_requests.stop()
+        self.journal.close()
+
+
+class CheckFailed(Exception):
+    def __init__(self, failure, message):
+        super(CheckFailed, self).__init__(message)
+        self.failure = failure
+        self.message = message
+
+
+def _is_upgradable(instance_details, migration_config):
+    return (
+        instance_details.get('status') == 'Ready'
+        and instance_details.get('package_version') == migration_config['APP_SAFE_DELETE_VERSION']
+    )
+
+
+def _prefetch_subscriptions(aps, subscription_ids):
+    subscription_ids = sorted(set(subscription_ids))
+    print(f"Loading {len(subscription_ids)} subscriptions")
+    return {
+        'bss': _index_by_subscription(aps.find_in(
+            constants.BSS_SUBSCRIPTION, 'subscriptionId', subscription_ids, select='servicePlan,account'
+        )),
+        'oss': _index_by_subscription(aps.find_in(
+            constants.OSS_SUBSCRIPTION, 'subscriptionId', subscription_ids
+        )),
+    }
+
+
+def _index_by_subscription(resources):
+    index = {}
+    for resource in resources:
+        index.setdefault(str(resource['subscriptionId']), resource)
+    return index
+
+
+def _migrate_instance(run, record):
+    # The worker is only held until the change order is placed, the later stages continue
+    # from the order, activation and Connect futures in the threads resolving them
+    done = Future()
+    try:
+        state = _start_instance(run, record)
+    except BaseException:
+        progress.move(record.instance_id, 'failed')
+        raise
+    if state:
+        _wait_order(run, record, done, state)
+    else:
+        done.set_result(None)
+    return done
+
+
+def _continue(run, record, done, future, step, state):
+    # Runs the next stage of the instance once `future` resolves
+    def callback(future):
+        begin_block()
+        set_context(instance=record.instance_id, subscription=state['subscription'])
+        try:
+            step(run, record, done, future.result(), state)
+        except BaseException as e:
+            progress.move(record.instance_id, 'failed')
+            done.set_exception(e)
+        finally:
+            end_block()
+
+    future.add_done_callback(callback)
+
+
+def _start_instance(run, record):
+    instance_id = record.instance_id
+    set_context(instance=instance_id, subscription=record.subscription)
+    run.stage_marks[instance_id] = time.monotonic()
+    state = dict(run.previous.get(instance_id, {}))
+    progress.stage(instance_id, state.get('stage', 'validated'))
+    if stage_reached(state.get('stage'), 'order_placed'):
+        print(f"Resuming instance {instance_id} of subscription {state['subscription']} "
+              f"from stage {state['stage']}")
+        return state
+    return _place_order(run, record)
+
+
+def _wait_order(run, record, done, state):
+    if stage_reached(state['stage'], 'order_completed'):
+        _activate_tenant(run, record, done, state)
+    else:
+        _continue(run, record, done, run.order_poller.wait(state['orderId']), _order_finished, state)
+
+
+def _order_finished(run, record, done, status, state):
+    instance_id = record.instance_id
+    if status != ORDER_COMPLETED:
+        if status is None:
+            _fail(run, instance_id, 'order_timeout',
+                  f"Order {state['orderId']} provisioning did not finish in time, "
+                  f"instance {instance_id} is not migrated", order=state['orderId'])
+        else:
+            _fail(run, instance_id, 'order_failed',
+                  f"Order {state['orderId']} provisioning ended in status {status}, "
+                  f"instance {instance_id} is not migrated", order=state['orderId'])
+        done.set_result(None)
+        return
+    state['stage'] = 'order_completed'
+    _record_stage(run, instance_id, 'order_completed')
+    _activate_tenant(run, record, done, state)
+
+
+def _activate_tenant(run, record, done, state):
+    if stage_reached(state['stage'], 'tenant_activated'):
+        _approve_request(run, record, done, state)
+    else:
+        future = run.activator.submit(record.instance_id, state['tenant'], state['oss_subscription'])
+        _continue(run, record, done, future, _tenant_activated, state)
+
+
+def _tenant_activated(run, record, done, result, state):
+    instance_id = record.instance_id
+    subscription = state['subscription']
+    tenant_id, error = result
+    if error:
+        _fail(run, instance_id, 'activation_failed',
+              f"Tenant activation for subscription {subscription} failed, "
+              f"instance {instance_id} is not migrated. Error: {error}", error=error)
+        done.set_result(None)
+        return
+    print(f"Tenant {tenant_id} activated for subscription {subscription}")
+    state['stage'] = 'tenant_activated'
+    _record_stage(run, instance_id, 'tenant_activated', sync=True, tenant_id=tenant_id)
+    _approve_request(run, record, done, state)
+
+
+def _approve_request(run, record, done, state):
+    future = run.purchase_requests.wait(state['subscription'])
+    _continue(run, record, done, future, _request_approved, state)
+
+
+def _request_approved(run, record, done, result, state):
+    instance_id = record.instance_id
+    subscription = state['subscription']
+    request, error = result
+    if not request:
+        _fail(run, instance_id, 'connect_timeout',
+              f"Purchase request for subscription {subscription} did not reach connect in time, "
+              "please approve it manually")
+        done.set_result(None)
+        return
+    if error:
+        print(f'Error while approving request {request}')
+        print(f'Error: {error}')
+        print('Please approve it manually')
+    else:
+        print(
+            f'Approved request {request} with template '
+            f'{run.config["CONNECT_ACTIVATION_TEMPLATE"]}'
+        )
+    _record_stage(run, instance_id, 'connect_approved', sync=True, request=request,
+                  error=str(error) if error else None)
+    if run.snapshot is not None:
+        run.snapshot.update(record)
+    run.retry_queue.discard(instance_id)
+    print(f"Migration over for subscription {subscription}")
+    done.set_result(None)
+
+
+def _record_stage(run, instance_id, stage, sync=False, **data):
+    now = time.monotonic()
+    stats.record_stage(instance_id, stage, now - run.stage_marks.get(instance_id, now))
+    run.stage_marks[instance_id] = now
+    run.journal.record(instance_id, stage, sync=sync, **data)
+    progress.stage(instance_id, stage)
+    log_event(stage, **data)
+    flush_logs()
+
+
+def _outcome(instance_id, outcome, **fields):
+    progress.move(instance_id, outcome)
+    log_event(outcome, **fields)
+
+
+def _fail(run, instance_id, failure, message, outcome='failed', **fields):
+    print(message)
+    _outcome(instance_id, outcome, failure=failure, message=message, **fields)
+    if run.policy.aborts(failure):
+        print(f"Migration aborted by policy on {failure} of instance {instance_id}")
+        sys.exit(1)
+    if run.retry_queue.add(instance_id, failure, message, run.policy.retry_attempts):
+        print(f"Instance {instance_id} added to the retry queue")
+    else:
+        print(f"Instance {instance_id} failed {run.policy.retry_attempts} retries, "
+              "removed from the retry queue")
+        log_event('retries_exhausted', failure=failure)
+
+
+def _place_order(run, record):
+    instance_id = record.instance_id
+    try:
+        _check_instance(record, run.config)
+        planned = run.planned.get(instance_id)
+        if planned:
+            _active_subscription(run, planned['subscription'])
+        else:
+            planned = _plan_instance(run, record)
+    except CheckFailed as e:
+        if run.snapshot is not None and e.failure in SETTLED_FAILURES:
+            run.snapshot.update(record)
+        _fail(run, instance_id, e.failure, e.message, outcome='skipped')
+        return None
+
+    _record_stage(run, instance_id, 'validated', subscription=planned['subscription'])
+    print(f"Change order with following data: {planned['order']}")
+    change_order = run.hub.aps.post('/aps/2/services/order-manager/orders', json=planned['order']).json()
+    print(f"Order created {change_order}")
+    print(f"The tenant to be activated: {json.dumps(planned['tenant'])}")
+    state = {
+        'stage': 'order_placed',
+        'subscription': planned['subscription'],
+        'oss_subscription': planned['oss_subscription'],
+        'tenant': planned['tenant'],
+        'orderId': change_order['orderId'],
+    }
+    _record_stage(run, instance_id, sync=True, **state)
+    return state
+
+
+def _check_instance(record, migration_config):
+    instance_id = record.instance_id
+    if record.status != 'Ready':
+        raise CheckFailed('not_ready', f"Instance {instance_id} is not in Ready status, skipping")
+    if record.package_version != migration_config['APP_SAFE_DELETE_VERSION']:
+        raise CheckFailed(
+            'wrong_version', f"Instance {instance_id} is not in proper version for safe upgrade"
+        )
+
+
+def _plan_instance(run, record):
+    hub = run.hub
+    migration_config = run.config
+    mappings = run.mappings
+    instance_id = record.instance_id
+    _check_instance(record, migration_config)
+    subscription = record.subscription
+    activation_params = _populate_params(record, migration_config['PARAMS_MAPPING'])
+    if not subscription:
+        raise CheckFailed(
+            'no_subscription',
+            f"Instance {instance_id} has no setting for "
+            f"{migration_config['SUBSCRIPTION_ID_SETTING']} and due it can't "
+            f"be discovered the subscription"
+        )
+    print(f"Instance {instance_id} is from subscription {subscription}")
+    bss_subscription, oa_subscription = _active_subscription(run, subscription)
+    new_plan, resource_map = run.plan_cache.get_or_load(
+        (bss_subscription["servicePlan"]["aps"]["id"],
+         json.dumps(bss_subscription['subscriptionPeriod'], sort_keys=True)),
+        lambda: _resolve_new_plan(hub.aps, bss_subscription, subscription, mappings),
+    )
+    resources = hub.aps.get(f'aps/2/resources/{bss_subscription["aps"]["id"]}/resources').json()
+    return {
+        'subscription': subscription,
+        'oss_subscription': oa_subscription['aps']['id'],
+        'order': _build_order(bss_subscription, new_plan, resources, mappings, resource_map),
+        'tenant': _get_new_tenant(activation_params, migration_config['CONNECT_PRODUCT_ID']),
+    }
+
+
+def _active_subscription(run, subscription):
+    bss_subscription = run.subscriptions['bss'].get(str(subscription))
+    oa_subscription = run.subscriptions['oss'].get(str(subscription))
+    if not bss_subscription or not oa_subscription:
+        raise CheckFailed('subscription_not_found', f"Subscription {subscription} not found in the hub")
+    if bss_subscription['status'] != 'ACTIVE':
+        raise CheckFailed(
+            'inactive_subscription',
+            f"Subscription {subscription} is not active, is in status {bss_subscription['status']} "
+            "and due it can't be migrated"
+        )
+    return bss_subscription, oa_subscription
+
+
+def _resolve_new_plan(aps, bss_subscription, subscription, mappings):
+    period_switches = aps.post(
+        f'aps/2/resources/{bss_subscription["servicePlan"]["aps"]["id"]}/planPeriodSwitches',
+        json=bss_subscription['subscriptionPeriod']
+    ).json()
+
+    if _potential_plans(period_switches) != 2:
+        raise CheckFailed(
+            'multiple_upgrade_paths',
+            f"Source plan for subscription {subscription} has more than one upgrade path,"
+            f"Is not possible to migrate."
+        )
+    new_plan = _select_new_plan(bss_subscription["servicePlan"]["aps"]["id"], period_switches)
+    new_plan_data = aps.get(f'aps/2/resources/{new_plan}').json()
+    if not new_plan_data:
+        raise CheckFailed('new_plan_not_found', "Error obtaining new plan")
+    return new_plan, _plan_resource_map(new_plan_data, mappings)
+
+
+def _plan_resource_map(new_plan_data, mappings):
+    resource_map = {}
+    for source, destinations in mappings.items():
+        for new_resource in new_plan_data['resourceRates']:
+            if new_resource['resourceId'] in destinations:
+                resource_map[source] = new_resource['resourceId']
+    return resource_map
+
+
+def _build_order(bss_subscription, new_plan, resources, mappings, resource_map):
+    order = {
+        "type": "CHANGE",
+        "subscriptionId": bss_subscription['aps']['id'],
+        "period": bss_subscription['subscriptionPeriod'],
+        "planId": new_plan,
+        "resources": []
+    }
+
+    for resource in resources:
+        if not resource['resourceId'] in mappings:
+            raise CheckFailed(
+                'unmapped_resource', f"Resource {resource['id']} not present in mappings! unsure what to do"
             )
-            while True:
-                request = _connect_purchase_request_pending(connect_client, subscription, migration_config['CONNECT_PRODUCT_ID'])
-                if not request:
-                    print("Order did not reached connect yet")
-                    _confirm("Let's wait? [y/n]")
-                break
-            print(
-                f'Approving request {request} with template '
-                f'{migration_config["CONNECT_ACTIVATION_TEMPLATE"]}'
-            )
-            try:
-                connect_client.requests[request].action('approve').post({
-                    'template_id': migration_config['CONNECT_ACTIVATION_TEMPLATE']
-                })
-            except ClientError as error:
-                print(f'Error while approving request {request}')
-                print(f'Error: {error}')
-                print('Please approve it manually')
-            print(f"Migration over for subscription {subscription}")
+        order['resources'].append({
+            "resourceId": resource_map.get(resource['resourceId'], ""),
+            "amount": int(resource['included'] + resource['additional'])
+        })
+    return order
+
 
+def _run_pipeline(instances, migrate, workers):
+    # migrate() returns once the instance no longer needs a worker, with a future
+    # resolved when the instance is finished
+    stop = threading.Event()
+    finished = []
 
+    def stop_on_failure(done):
+        if done.exception() is not None:
+            stop.set()
+
+    def run(inst):
+        if stop.is_set():
+            return
+        begin_block()
+        try:
+            done = migrate(inst)
+        except BaseException:
+            # Set before the failure reaches the main thread, this thread may pick up the next instance
+            stop.set()
+            raise
+        finally:
+            end_block()
+        done.add_done_callback(stop_on_failure)
+        finished.append(done)
 
-def _populate_params(instance_settings, configuration_map):
+    try:
+        if workers <= 1:
+            for inst in instances:
+                run(inst)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(run, inst) for inst in instances]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    stop.set()
+                    for future in futures:
+                        future.cancel()
+                    raise
+        for done in as_completed(finished):
+            done.result()
+    except BaseException:
+        stop.set()
+        print("Stopping migration, waiting for instances in progress to finish")
+        raise
+
+
+def _populate_params(record, configuration_map):
     activationParams = []
     for key in configuration_map:
-        value = _setting_from_settings(instance_settings, key)
+        value = record.setting(key)
         if not value:
-            print(f"App instance has no key {key}, probably there is a missconfiguration or broken instance")
-            exit(1)
+            raise CheckFailed(
+                'missing_setting',
+                f"App instance has no key {key}, probably there is a missconfiguration or broken instance"
+            )
         activationParams.append({
             "key": configuration_map[key],
             "value": value
@@ -196,26 +846,52 @@ def _get_new_tenant(activationParams, productID):
     }
 
 
-def _load_mappings(mappings, aps):
-    aps_mapping = {}
-    for map in mappings:
-        source = aps.get(
-            f'aps/2/resources?implementing(http://www.odin.com/billing/Resource/1.3),eq(id,{map})'
-        ).json()
-        if source and len(source) == 1:
-            destinations = []
-            for dest in mappings[map]:
-                destination = aps.get(
-                    f'aps/2/resources?implementing(http://www.odin.com/billing/Resource/1.3),eq(id,{dest})'
-                ).json()
-                if not destination or len(destination) != 1:
-                    print(f"Wrong mapping, resource {dest} does not exist")
-                    exit(1)
-                destinations.append(destination[0]['aps']['id'])
-            aps_mapping[source[0]['aps']['id']] = destinations
+def _load_mappings(mappings, aps, hub_id=None, use_cache=False):
+    cache_key = None
+    if use_cache:
+        digest = hashlib.sha256(json.dumps(mappings, sort_keys=True).encode('utf-8')).hexdigest()
+        cache_key = f'{hub_id}:{digest}'
+        cached = _read_mapping_cache().get(cache_key)
+        if cached is not None:
+            print("Resource mappings loaded from cache")
+            return {source: frozenset(destinations) for source, destinations in cached.items()}
+
+    resource_ids = set(mappings)
+    for destinations in mappings.values():
+        resource_ids.update(destinations)
+    found = {}
+    for resource in aps.find_in(constants.BILLING_RESOURCE, 'id', sorted(resource_ids, key=str)):
+        found.setdefault(str(resource['id']), []).append(resource['aps']['id'])
+    missing = sorted(str(resource_id) for resource_id in resource_ids
+                     if len(found.get(str(resource_id), [])) != 1)
+    if missing:
+        print(f"Wrong mapping, resources {', '.join(missing)} do not exist")
+        exit(1)
+
+    aps_mapping = {
+        found[str(source)][0]: frozenset(found[str(dest)][0] for dest in destinations)
+        for source, destinations in mappings.items()
+    }
+    if cache_key:
+        _write_mapping_cache(cache_key, aps_mapping)
     return aps_mapping
 
 
+def _read_mapping_cache():
+    try:
+        with open(MAPPING_CACHE_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_mapping_cache(cache_key, aps_mapping):
+    cache = _read_mapping_cache()
+    cache[cache_key] = {source: sorted(destinations) for source, destinations in aps_mapping.items()}
+    with open(MAPPING_CACHE_FILE, 'w') as f:
+        json.dump(cache, f, indent=4)
+
+
 def _potential_plans(available_plans):
     counter = 0
     for plan in available_plans:
@@ -230,70 +906,19 @@ def _select_new_plan(old_plan, available_plans):
             return plan['target']['planId']
 
 
-def _setting_from_settings(settings, key):
-    for setting in settings:
-        if setting['name'] == key:
-            return setting['value']
-    return None
-
-
-def _is_order_ready(order, aps):
-    order = aps.get(f'aps/2/services/order-manager/orders/{order}').json()
-    return True if order['provisioningStatus'] == 'COMPLETED' else False
-
-
-def _connect_purchase_request_pending(client, subscriptionId, productId):
-    r = R().asset.product.id.eq(f'{productId}')
-    r &= R().asset.external_id.eq(f'{subscriptionId}')
-    r &= R().type.eq('purchase')
-    r &= R().status.oneof(['pending','inquiring', 'approved', 'failed', 'tiers_setup'])
-    try:
-        requests = client.requests.filter(r).all()
-    except ClientError as error:
-        print(
-            f'Error when retriving data from connect, status code: {error.status_code}',
-            f'Errors: {error.errors}'
-        )
-        return None
-    if requests.count() != 1:
-        return None
-    if requests[0]['status'] != 'pending':
-        print(
-            f'Request created with id {requests[0]["id"]} is in status {requests[0]["status"]}.'
-            'Check manually why is not pending'
-        )
-        return None
-    return requests[0]['id']
-
-def _confirm(prompt):
-    while True:
-        try:
-            answer = strtobool(input(prompt))
-            if not answer:
-                sys.exit(1)
-
-        except ValueError:
-            continue
-        except EOFError:
-            sys.exit(1)
-        else:
-            break
-    return answer
-
-
-def _check_binding(check_config, get_config_info):
+def _check_binding(get_config_info):
     state_not_initiated = "\tNot initiated"
     state_is_ready = "\thost: {}\n\tuser: {}"
     state_config_corrupted = "\tConfig file is corrupted: {}"
 
-    if not check_config():
-        return state_not_initiated
-
     try:
         info = get_config_info()
     except Exception as e:
         return state_config_corrupted.format(e)
 
+    if info is None:
+        return state_not_initiated
+
     if info == NULL_CFG_INFO:
         return state_config_corrupted.format("binding attributes are not assigned")
     else:
@@ -302,11 +927,11 @@ def _check_binding(check_config, get_config_info):
 
 
 def _get_hub_info():
-    if not os.path.exists(CFG_FILE_PATH):
-        return NULL_CFG_INFO
-
-    with open(CFG_FILE_PATH) as f:
-        hub_cfg = json.load(f)
+    try:
+        with open(CFG_FILE_PATH) as f:
+            hub_cfg = json.load(f)
+    except FileNotFoundError:
+        return None
 
     host = "{}:{}".format(hub_cfg['host'], hub_cfg['port'])
     user = hub_cfg['user']
@@ -315,8 +940,8 @@ def _get_hub_info():
 
 def main():
     try:
-        log_entry = ("=============================\n{}\n".format(" ".join(sys.argv)))
-        Logger(LOG_FILE).log(log_entry)
+        import fire
+
         fire.Fire(Migrator, name='migrator')
     except Exception as e:
         print("Error: {}".format(e))
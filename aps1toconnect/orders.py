@@ -0,0 +1,109 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+ORDER_POLL_TIMEOUT = 3600
+ORDER_POLL_MIN_INTERVAL = 5
+ORDER_POLL_MAX_INTERVAL = 120
+ORDER_POLL_RATE = 5
+ORDER_POLL_WORKERS = 4
+ORDER_COMPLETED = 'COMPLETED'
+# Provisioning statuses after which the order will not complete any more
+ORDER_FAILED_STATUSES = ('FAILED', 'PROVISIONING_FAILED', 'CANCELLED', 'CANCELED', 'DECLINED')
+
+
+class OrderPoller(object):
+    """Polls all outstanding change orders with per order backoff and a shared rate limit.
+
+    wait() returns a future resolved to the final provisioning status, COMPLETED or
+    one of ORDER_FAILED_STATUSES, or to None on timeout.
+    """
+
+    def __init__(self, aps, timeout=ORDER_POLL_TIMEOUT, min_interval=ORDER_POLL_MIN_INTERVAL,
+                 max_interval=ORDER_POLL_MAX_INTERVAL, rate=ORDER_POLL_RATE,
+                 workers=ORDER_POLL_WORKERS):
+        self.aps = aps
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.rate = rate
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._schedule, name='order-poller', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_config(cls, aps, migration_config):
+        options = migration_config.get('ORDER_POLL', {})
+        return cls(
+            aps,
+            timeout=options.get('timeout', ORDER_POLL_TIMEOUT),
+            min_interval=options.get('min_interval', ORDER_POLL_MIN_INTERVAL),
+            max_interval=options.get('max_interval', ORDER_POLL_MAX_INTERVAL),
+            rate=options.get('rate', ORDER_POLL_RATE),
+            workers=options.get('workers', ORDER_POLL_WORKERS),
+        )
+
+    def wait(self, order_id):
+        future = Future()
+        deadline = time.monotonic() + self.timeout
+        self._push(time.monotonic(), order_id, future, deadline, 0)
+        return future
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+        for _, _, _, future, _, _ in self._queue:
+            future.cancel()
+
+    def _push(self, due, order_id, future, deadline, attempt):
+        with self._condition:
+            heapq.heappush(self._queue, (due, next(self._sequence), order_id, future, deadline, attempt))
+            self._condition.notify()
+
+    def _schedule(self):
+        last_check = 0
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    now = time.monotonic()
+                    if self._queue:
+                        wait = max(self._queue[0][0], last_check + 1.0 / self.rate) - now
+                        if wait <= 0:
+                            break
+                        self._condition.wait(wait)
+                    else:
+                        self._condition.wait()
+                if self._stopped:
+                    return
+                _, _, order_id, future, deadline, attempt = heapq.heappop(self._queue)
+                last_check = time.monotonic()
+            self._executor.submit(self._check, order_id, future, deadline, attempt)
+
+    def _check(self, order_id, future, deadline, attempt):
+        try:
+            order = self.aps.get(f'aps/2/services/order-manager/orders/{order_id}').json()
+            status = order['provisioningStatus']
+        except Exception as e:
+            print(f"Failed to check order {order_id}: {e}")
+            status = None
+
+        if status == ORDER_COMPLETED or status in ORDER_FAILED_STATUSES:
+            future.set_result(status)
+            return
+        now = time.monotonic()
+        if now >= deadline:
+            future.set_result(None)
+            return
+        delay = min(self.max_interval, self.min_interval * 2 ** attempt)
+        delay *= random.uniform(0.5, 1.5)
+        self._push(min(now + delay, deadline), order_id, future, deadline, attempt + 1)
@@ -0,0 +1,131 @@
+import json
+import os
+import sys
+import threading
+
+SKIP = 'skip'
+ABORT = 'abort'
+ACTIONS = (SKIP, ABORT)
+
+# Action taken on every failure class unless POLICY.failures says otherwise: instances
+# that can be migrated later are skipped, configuration problems stop the run
+DEFAULT_ACTIONS = {
+    'not_ready': SKIP,
+    'wrong_version': SKIP,
+    'inactive_subscription': SKIP,
+    'no_subscription': ABORT,
+    'subscription_not_found': ABORT,
+    'multiple_upgrade_paths': ABORT,
+    'new_plan_not_found': ABORT,
+    'unmapped_resource': ABORT,
+    'missing_setting': ABORT,
+    'order_timeout': SKIP,
+    'order_failed': SKIP,
+    'activation_failed': SKIP,
+    'connect_timeout': SKIP,
+}
+# POLICY.max_wait and POLICY.retries keys -> section and option of the component applying them
+WAIT_OPTIONS = {
+    'order': ('ORDER_POLL', 'timeout'),
+    'connect': ('CONNECT_POLL', 'timeout'),
+}
+RETRY_OPTIONS = {
+    'tenant_activation': ('TENANT_ACTIVATION', 'retries'),
+}
+RETRY_QUEUE_ATTEMPTS = 3
+
+
+class Policy(object):
+    """Unattended decisions of a migration, read from the POLICY section of migration.json.
+
+        "POLICY": {
+            "failures": {"not_ready": "skip", "unmapped_resource": "abort"},
+            "default": "abort",
+            "max_wait": {"order": 1800, "connect": 600},
+            "retries": {"tenant_activation": 3, "instance": 3}
+        }
+    """
+
+    def __init__(self, actions=None, default=None, max_wait=None, retries=None):
+        self.actions = dict(DEFAULT_ACTIONS, **(actions or {}))
+        self.default = default or ABORT
+        self.max_wait = max_wait or {}
+        self.retries = retries or {}
+        for failure, action in list(self.actions.items()) + [('default', self.default)]:
+            if action not in ACTIONS:
+                print(f"POLICY action for {failure} must be one of {', '.join(ACTIONS)}, got {action}")
+                sys.exit(1)
+
+    @classmethod
+    def from_config(cls, migration_config):
+        options = migration_config.get('POLICY', {})
+        return cls(
+            actions=options.get('failures'),
+            default=options.get('default'),
+            max_wait=options.get('max_wait'),
+            retries=options.get('retries'),
+        )
+
+    def action(self, failure):
+        return self.actions.get(failure, self.default)
+
+    def aborts(self, failure):
+        return self.action(failure) == ABORT
+
+    @property
+    def retry_attempts(self):
+        return self.retries.get('instance', RETRY_QUEUE_ATTEMPTS)
+
+    def component_config(self, migration_config):
+        # The waits and retries are applied by the order poller, the purchase request
+        # approver and the tenant activator, which read them from their own sections
+        config = dict(migration_config)
+        for values, options in ((self.max_wait, WAIT_OPTIONS), (self.retries, RETRY_OPTIONS)):
+            for key, (section, option) in options.items():
+                if key in values:
+                    config[section] = dict(config.get(section, {}), **{option: values[key]})
+        return config
+
+
+class RetryQueue(object):
+    """Instances skipped by the policy, kept across runs until they migrate or run out of attempts."""
+
+    def __init__(self, entries=None):
+        self._entries = entries or {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def load(path):
+        try:
+            with open(path) as f:
+                return RetryQueue(json.load(f))
+        except (IOError, ValueError):
+            return RetryQueue()
+
+    def add(self, instance_id, failure, message=None, max_attempts=RETRY_QUEUE_ATTEMPTS):
+        """Queue the instance again, returns False once it used up its attempts."""
+        with self._lock:
+            key = str(instance_id)
+            attempts = self._entries.get(key, {}).get('attempts', 0) + 1
+            if attempts > max_attempts:
+                self._entries.pop(key, None)
+                return False
+            self._entries[key] = {'failure': failure, 'message': message, 'attempts': attempts}
+            return True
+
+    def discard(self, instance_id):
+        with self._lock:
+            self._entries.pop(str(instance_id), None)
+
+    def __contains__(self, instance_id):
+        return str(instance_id) in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def save(self, path):
+        with self._lock:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._entries, f, indent=4)
+            os.replace(tmp_path, path)
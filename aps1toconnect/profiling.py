@@ -0,0 +1,122 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+_ID_SEGMENT = re.compile(r'^([0-9a-fA-F]{8}-[0-9a-fA-F-]{27}|\d+|[A-Z]{2,3}-[\d-]+)$')
+_IMPLEMENTING = re.compile(r'implementing\(([^)]*)\)')
+
+
+def endpoint_pattern(uri):
+    path, _, query = uri.lstrip('/').partition('?')
+    # The first two segments are the API name and version, as in aps/2
+    segments = path.split('/')
+    path = '/'.join(segments[:2] + ['{id}' if _ID_SEGMENT.match(segment) else segment
+                                    for segment in segments[2:]])
+    types = _IMPLEMENTING.findall(query)
+    if types:
+        path += '?' + ','.join('implementing({})'.format(t) for t in types)
+    return path
+
+
+def _percentile(ordered, percent):
+    if not ordered:
+        return 0.0
+    index = max(int(round(percent / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+class CallStats(object):
+    """Latency of hub and Connect calls per endpoint, and wall-clock time per instance stage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stages = {}
+
+    def record(self, category, endpoint, seconds, size=0):
+        with self._lock:
+            entry = self._calls.setdefault((category, endpoint), {'times': [], 'bytes': 0})
+            entry['times'].append(seconds)
+            entry['bytes'] += size
+
+    @contextmanager
+    def timer(self, category, endpoint):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(category, endpoint, time.monotonic() - start)
+
+    def record_stage(self, instance_id, stage, seconds):
+        with self._lock:
+            self._stages.setdefault(instance_id, {})[stage] = seconds
+
+    def summary(self):
+        with self._lock:
+            calls = {key: (sorted(entry['times']), entry['bytes']) for key, entry in self._calls.items()}
+            stages = {}
+            for timings in self._stages.values():
+                for stage, seconds in timings.items():
+                    stages.setdefault(stage, []).append(seconds)
+        rows = [
+            _summary_row(category, endpoint, times, size)
+            for (category, endpoint), (times, size) in calls.items()
+        ]
+        rows += [
+            _summary_row('stage', stage, sorted(times), 0)
+            for stage, times in stages.items()
+        ]
+        return sorted(rows, key=lambda row: row['total'], reverse=True)
+
+    def print_summary(self):
+        rows = self.summary()
+        if not rows:
+            return
+        print("{:<8} {:<60} {:>7} {:>9} {:>7} {:>7} {:>7} {:>10}".format(
+            'kind', 'endpoint', 'count', 'total s', 'p50', 'p95', 'p99', 'bytes'))
+        for row in rows:
+            print("{kind:<8} {endpoint:<60.60} {count:>7} {total:>9.1f} {p50:>7.3f} "
+                  "{p95:>7.3f} {p99:>7.3f} {bytes:>10}".format(**row))
+
+    def export(self, path, samples=False):
+        with self._lock:
+            stages = {str(instance): dict(timings) for instance, timings in self._stages.items()}
+            raw = [
+                {'kind': category, 'endpoint': endpoint, 'times': list(entry['times']), 'bytes': entry['bytes']}
+                for (category, endpoint), entry in self._calls.items()
+            ] if samples else None
+        report = {'calls': self.summary(), 'instances': stages}
+        if samples:
+            report['samples'] = raw
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=None if samples else 4)
+
+    def merge(self, path):
+        # Only exports written with samples keep the raw timings percentiles are computed from
+        with open(path) as f:
+            report = json.load(f)
+        with self._lock:
+            for sample in report.get('samples', []):
+                entry = self._calls.setdefault((sample['kind'], sample['endpoint']), {'times': [], 'bytes': 0})
+                entry['times'].extend(sample['times'])
+                entry['bytes'] += sample['bytes']
+            for instance, timings in report.get('instances', {}).items():
+                self._stages.setdefault(instance, {}).update(timings)
+
+
+def _summary_row(kind, endpoint, times, size):
+    return {
+        'kind': kind,
+        'endpoint': endpoint,
+        'count': len(times),
+        'total': sum(times),
+        'p50': _percentile(times, 50),
+        'p95': _percentile(times, 95),
+        'p99': _percentile(times, 99),
+        'bytes': size,
+    }
+
+
+stats = CallStats()
@@ -0,0 +1,214 @@
+import json
+import os
+import threading
+import time
+from collections import Counter, deque
+
+from aps1toconnect.action_logger import write_terminal
+from aps1toconnect.throttle import governor
+
+STATES = ('validating', 'order_pending', 'activating', 'awaiting_connect', 'done', 'skipped', 'failed')
+FINAL_STATES = ('done', 'skipped', 'failed')
+# Journal stage reached -> state the instance is in until the next stage
+STAGE_STATES = {
+    'validated': 'validating',
+    'order_placed': 'order_pending',
+    'order_completed': 'activating',
+    'tenant_activated': 'awaiting_connect',
+    'connect_approved': 'done',
+}
+PROGRESS_INTERVAL = 10
+PROGRESS_WINDOW = 300
+# Rate limiter state -> metric name, type
+RATE_LIMIT_METRICS = (
+    ('rate', 'aps1toconnect_rate_limit', 'gauge'),
+    ('max_rate', 'aps1toconnect_rate_limit_max', 'gauge'),
+    ('requests', 'aps1toconnect_rate_limit_requests_total', 'counter'),
+    ('errors', 'aps1toconnect_rate_limit_errors_total', 'counter'),
+    ('waited', 'aps1toconnect_rate_limit_waited_seconds_total', 'counter'),
+)
+
+
+class Progress(object):
+    """Instances per state, throughput and API error rate of the running migration.
+
+    Fed by the migration pipeline and the hub clients; while started, a reporter
+    thread rewrites the status files and prints a progress line every `interval`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+        self._counts = Counter()
+        self._finished = deque()
+        self._calls = deque()
+        self.total = 0
+        self.started = None
+        self._reporter = None
+        self._stop = threading.Event()
+        self._server = None
+
+    def start(self, total, status_file=None, metrics_file=None, metrics_port=None,
+              interval=PROGRESS_INTERVAL, terminal=True):
+        with self._lock:
+            self.total = total
+            self.started = time.monotonic()
+        self.status_file = status_file
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.terminal = terminal
+        if metrics_port:
+            self._serve(metrics_port)
+        self._stop.clear()
+        self._reporter = threading.Thread(target=self._report_loop, name='progress', daemon=True)
+        self._reporter.start()
+
+    def stop(self):
+        if self._reporter is None:
+            return
+        self._stop.set()
+        self._reporter.join()
+        self._reporter = None
+        self._report()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def move(self, instance_id, state):
+        now = time.monotonic()
+        with self._lock:
+            previous = self._states.get(instance_id)
+            if previous == state:
+                return
+            if previous:
+                self._counts[previous] -= 1
+            self._states[instance_id] = state
+            self._counts[state] += 1
+            if state in FINAL_STATES:
+                self._finished.append((now, state))
+                self._trim(self._finished, now)
+
+    def stage(self, instance_id, stage):
+        if stage in STAGE_STATES:
+            self.move(instance_id, STAGE_STATES[stage])
+
+    def record_call(self, status=None, error=False):
+        now = time.monotonic()
+        failed = error or status == 429 or (status is not None and status >= 500)
+        with self._lock:
+            self._calls.append((now, failed))
+            self._trim(self._calls, now)
+
+    @staticmethod
+    def _trim(events, now):
+        while events and now - events[0][0] > PROGRESS_WINDOW:
+            events.popleft()
+
+    def status(self):
+        now = time.monotonic()
+        with self._lock:
+            self._trim(self._finished, now)
+            self._trim(self._calls, now)
+            counts = {state: self._counts[state] for state in STATES}
+            finished_recently = len(self._finished)
+            calls = len(self._calls)
+            errors = sum(1 for _, failed in self._calls if failed)
+            total = self.total
+            elapsed = now - self.started if self.started else 0.0
+        finished = sum(counts[state] for state in FINAL_STATES)
+        in_flight = sum(counts.values()) - finished
+        window = min(elapsed, PROGRESS_WINDOW) or 1.0
+        throughput = finished_recently / window * 60
+        remaining = max(total - finished, 0)
+        return {
+            'total': total,
+            'states': counts,
+            'finished': finished,
+            'in_flight': in_flight,
+            'throughput_per_minute': round(throughput, 2),
+            'eta_seconds': round(remaining / throughput * 60) if throughput else None,
+            'api_calls': calls,
+            'api_error_rate': round(errors / calls, 4) if calls else 0.0,
+            'elapsed_seconds': round(elapsed),
+            'rate_limits': governor.state(),
+        }
+
+    def metrics(self, status=None):
+        status = status or self.status()
+        lines = [
+            '# HELP aps1toconnect_instances Instances of the migration by state',
+            '# TYPE aps1toconnect_instances gauge',
+        ]
+        lines += ['aps1toconnect_instances{{state="{}"}} {}'.format(state, count)
+                  for state, count in status['states'].items()]
+        for name in ('total', 'in_flight', 'throughput_per_minute', 'eta_seconds', 'api_error_rate'):
+            if status[name] is not None:
+                lines += ['# TYPE aps1toconnect_{} gauge'.format(name),
+                          'aps1toconnect_{} {}'.format(name, status[name])]
+        rate_limits = sorted(status['rate_limits'].items())
+        if rate_limits:
+            for key, metric, kind in RATE_LIMIT_METRICS:
+                lines.append('# TYPE {} {}'.format(metric, kind))
+                lines += ['{}{{budget="{}"}} {}'.format(metric, budget, state[key])
+                          for budget, state in rate_limits]
+        return '\n'.join(lines) + '\n'
+
+    def _report_loop(self):
+        while not self._stop.wait(self.interval):
+            self._report()
+
+    def _report(self):
+        status = self.status()
+        if self.status_file:
+            _replace(self.status_file, json.dumps(status, indent=4))
+        if self.metrics_file:
+            _replace(self.metrics_file, self.metrics(status))
+        if self.terminal:
+            write_terminal(_progress_line(status))
+
+    def _serve(self, port):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        progress = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/status':
+                    body, content_type = json.dumps(progress.status()), 'application/json'
+                else:
+                    body, content_type = progress.metrics(), 'text/plain; version=0.0.4'
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name='progress-metrics', daemon=True).start()
+
+
+def _replace(path, content):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _progress_line(status):
+    states = status['states']
+    eta = status['eta_seconds']
+    return ("[progress] {finished}/{total} finished ({done} done, {skipped} skipped, {failed} failed), "
+            "{in_flight} in flight: {validating} validating, {order_pending} order pending, "
+            "{activating} activating, {awaiting_connect} awaiting Connect | {rate}/min, ETA {eta} | "
+            "API errors {errors:.1%}\n").format(
+        finished=status['finished'], total=status['total'], in_flight=status['in_flight'],
+        rate=status['throughput_per_minute'], errors=status['api_error_rate'],
+        eta='{}m{:02d}s'.format(*divmod(eta, 60)) if eta is not None else '-', **states)
+
+
+progress = Progress()
@@ -0,0 +1,159 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from connect.client import ClientError, R
+
+from aps1toconnect.profiling import stats
+from aps1toconnect.progress import progress
+
+CONNECT_POLL_INTERVAL = 30
+CONNECT_POLL_TIMEOUT = 3600
+CONNECT_BATCH_SIZE = 100
+CONNECT_APPROVE_WORKERS = 4
+REQUEST_STATUSES = ['pending', 'inquiring', 'approved', 'failed', 'tiers_setup']
+
+
+class PurchaseRequestApprover(object):
+    """Finds the Connect purchase requests of all waiting subscriptions and approves them.
+
+    wait() returns a future resolved to (request_id, error); request_id is None
+    when no request showed up in time. A request already approved resolves without
+    error, one in any other status that is not pending resolves with an error.
+    Instances sharing a subscription share its request, every waiter gets the
+    outcome of the one approval.
+    """
+
+    def __init__(self, client, product_id, template_id, interval=CONNECT_POLL_INTERVAL,
+                 timeout=CONNECT_POLL_TIMEOUT, batch_size=CONNECT_BATCH_SIZE,
+                 workers=CONNECT_APPROVE_WORKERS):
+        self.client = client
+        self.product_id = product_id
+        self.template_id = template_id
+        self.interval = interval
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._waiting = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._poll, name='connect-poller', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_config(cls, client, migration_config):
+        options = migration_config.get('CONNECT_POLL', {})
+        return cls(
+            client,
+            migration_config['CONNECT_PRODUCT_ID'],
+            migration_config.get('CONNECT_ACTIVATION_TEMPLATE'),
+            interval=options.get('interval', CONNECT_POLL_INTERVAL),
+            timeout=options.get('timeout', CONNECT_POLL_TIMEOUT),
+            batch_size=options.get('batch_size', CONNECT_BATCH_SIZE),
+            workers=options.get('workers', CONNECT_APPROVE_WORKERS),
+        )
+
+    def wait(self, subscription):
+        future = Future()
+        with self._condition:
+            self._waiting.setdefault(str(subscription), []).append(
+                (future, time.monotonic() + self.timeout)
+            )
+            self._condition.notify()
+        return future
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+        for waiters in self._waiting.values():
+            for future, _ in waiters:
+                future.cancel()
+
+    def _poll(self):
+        while True:
+            with self._condition:
+                while not self._stopped and not self._waiting:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                subscriptions = list(self._waiting)
+
+            for start in range(0, len(subscriptions), self.batch_size):
+                self._match(subscriptions[start:start + self.batch_size])
+            self._expire()
+
+            with self._condition:
+                if not self._stopped:
+                    self._condition.wait(self.interval)
+
+    def _match(self, subscriptions):
+        r = R().asset.product.id.eq(f'{self.product_id}')
+        r &= R().asset.external_id.oneof(subscriptions)
+        r &= R().type.eq('purchase')
+        r &= R().status.oneof(REQUEST_STATUSES)
+        found = {}
+        try:
+            with stats.timer('connect', 'requests.filter'):
+                requests = list(self.client.requests.filter(r).all())
+            progress.record_call()
+            for request in requests:
+                found.setdefault(request['asset']['external_id'], []).append(request)
+        except ClientError as error:
+            progress.record_call(error=True)
+            print(
+                f'Error when retriving data from connect, status code: {error.status_code}',
+                f'Errors: {error.errors}'
+            )
+            return
+
+        for subscription, requests in found.items():
+            if len(requests) != 1:
+                continue
+            request = requests[0]
+            with self._condition:
+                waiting = self._waiting.pop(subscription, None)
+            if not waiting:
+                continue
+            futures = [future for future, _ in waiting]
+            if request['status'] == 'pending':
+                self._executor.submit(self._approve, request['id'], futures)
+                continue
+            if request['status'] == 'approved':
+                # Approved by an earlier run that stopped before recording it
+                result = (request['id'], None)
+            else:
+                result = (request['id'], f'Request created with id {request["id"]} is in status '
+                                         f'{request["status"]}. Check manually why is not pending')
+            for future in futures:
+                future.set_result(result)
+
+    def _approve(self, request_id, futures):
+        try:
+            with stats.timer('connect', 'requests.{id}.approve'):
+                self.client.requests[request_id].action('approve').post({
+                    'template_id': self.template_id
+                })
+        except ClientError as error:
+            progress.record_call(error=True)
+            result = (request_id, error)
+        else:
+            progress.record_call()
+            result = (request_id, None)
+        for future in futures:
+            future.set_result(result)
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._condition:
+            for subscription, waiters in list(self._waiting.items()):
+                for future, deadline in waiters:
+                    if deadline <= now:
+                        future.set_result((None, None))
+                waiters = [(future, deadline) for future, deadline in waiters if deadline > now]
+                if waiters:
+                    self._waiting[subscription] = waiters
+                else:
+                    del self._waiting[subscription]
@@ -0,0 +1,29 @@
+class InstanceRecord(object):
+    """The part of an application instance a migration needs.
+
+    `settings` is None when the settings were not fetched, otherwise a dict of the
+    configured setting names found on the instance.
+    """
+    __slots__ = ('instance_id', 'status', 'package_version', 'settings', 'subscription')
+
+    def __init__(self, instance_id, status, package_version, settings=None, subscription=None):
+        self.instance_id = instance_id
+        self.status = status
+        self.package_version = package_version
+        self.settings = settings
+        self.subscription = subscription
+
+    @staticmethod
+    def from_rpc(instance_id, details, settings, keys=None):
+        if settings is not None:
+            settings = {
+                setting['name']: setting['value'] for setting in settings
+                if keys is None or setting['name'] in keys
+            }
+        return InstanceRecord(instance_id, details.get('status'), details.get('package_version'), settings)
+
+    def setting(self, key):
+        return self.settings.get(key) if self.settings else None
+
+    def __repr__(self):
+        return 'InstanceRecord({}, {}, {})'.format(self.instance_id, self.status, self.package_version)
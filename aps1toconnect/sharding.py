@@ -0,0 +1,56 @@
+import hashlib
+import json
+import os
+
+
+def shard_of(key, shards):
+    # Python's hash() is salted per process, every host must agree on the shard of a key
+    digest = hashlib.sha1(str(key).encode('utf-8')).hexdigest()
+    return int(digest, 16) % shards
+
+
+def shard_key(record):
+    # Instances of the same subscription always land in the same shard, so two
+    # workers never place orders for one subscription
+    return record.subscription or 'instance-{}'.format(record.instance_id)
+
+
+def shard_path(path, index, directory=None):
+    root, ext = os.path.splitext(path)
+    path = '{}.shard-{}{}'.format(root, index, ext)
+    if directory:
+        path = os.path.join(directory, os.path.basename(path))
+    return path
+
+
+class Partition(object):
+    """Assignment of every instance to one of `shards` workers."""
+
+    def __init__(self, shards, assignments):
+        self.shards = shards
+        self.assignments = assignments
+
+    @staticmethod
+    def build(records, shards):
+        return Partition(shards, {
+            str(record.instance_id): shard_of(shard_key(record), shards) for record in records
+        })
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            data = json.load(f)
+        return Partition(data['shards'], data['assignments'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'shards': self.shards, 'assignments': self.assignments}, f)
+
+    def shard_of_instance(self, instance_id):
+        return self.assignments.get(str(instance_id))
+
+    def sizes(self):
+        sizes = [0] * self.shards
+        for shard in self.assignments.values():
+            sizes[shard] += 1
+        return sizes
@@ -0,0 +1,61 @@
+import hashlib
+import json
+import os
+import threading
+
+
+def settings_fingerprint(settings):
+    if settings is None:
+        return None
+    return hashlib.sha1(json.dumps(sorted(settings.items())).encode('utf-8')).hexdigest()
+
+
+class Snapshot(object):
+    """Instance state seen by the previous runs, used to find what changed since."""
+
+    def __init__(self, entries=None):
+        self._entries = entries or {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def load(path):
+        try:
+            with open(path) as f:
+                return Snapshot(json.load(f))
+        except (IOError, ValueError):
+            return Snapshot()
+
+    @staticmethod
+    def _entry(record):
+        return {
+            'status': record.status,
+            'package_version': record.package_version,
+            'settings': settings_fingerprint(record.settings),
+        }
+
+    def unchanged_listing(self, inst):
+        # Instances whose settings were never needed can be told apart from the listing alone
+        entry = self._entries.get(str(inst['application_instance_id']))
+        return (
+            entry is not None
+            and entry['settings'] is None
+            and entry['status'] == inst.get('status')
+            and entry['package_version'] == inst.get('package_version')
+        )
+
+    def changed(self, record):
+        return self._entries.get(str(record.instance_id)) != Snapshot._entry(record)
+
+    def update(self, record):
+        with self._lock:
+            self._entries[str(record.instance_id)] = Snapshot._entry(record)
+
+    def save(self, path):
+        with self._lock:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self._entries)
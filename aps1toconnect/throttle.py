@@ -0,0 +1,127 @@
+import threading
+import time
+
+BUDGETS = ('read', 'write', 'order', 'rpc')
+ADAPTIVE_LATENCY_TARGET = 2.0
+ADAPTIVE_MIN_RATE = 0.5
+ADAPTIVE_BACKOFF = 0.5
+ADAPTIVE_SLOWDOWN = 0.8
+ADAPTIVE_RECOVERY_STEP = 0.05
+ADAPTIVE_RECOVERY_AFTER = 20
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.requests = 0
+        self.errors = 0
+        self.waited = 0.0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Takes a token, or returns how long to wait before trying again."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.requests += 1
+                return 0
+            wait = (1 - self._tokens) / self.rate
+            self.waited += wait
+            return wait
+
+    def acquire(self):
+        wait = self.take()
+        while wait:
+            time.sleep(wait)
+            wait = self.take()
+
+    def adapt(self, seconds, failed, latency_target):
+        with self._lock:
+            if failed:
+                self.errors += 1
+                self._successes = 0
+                self.rate = max(ADAPTIVE_MIN_RATE, self.rate * ADAPTIVE_BACKOFF)
+            elif seconds > latency_target:
+                self._successes = 0
+                self.rate = max(ADAPTIVE_MIN_RATE, self.rate * ADAPTIVE_SLOWDOWN)
+            else:
+                self._successes += 1
+                if self._successes >= ADAPTIVE_RECOVERY_AFTER:
+                    self._successes = 0
+                    self.rate = min(self.max_rate, self.rate + self.max_rate * ADAPTIVE_RECOVERY_STEP)
+
+    def state(self):
+        with self._lock:
+            return {
+                'rate': round(self.rate, 2),
+                'max_rate': self.max_rate,
+                'requests': self.requests,
+                'errors': self.errors,
+                'waited': round(self.waited, 2),
+            }
+
+
+class Governor(object):
+    """Token buckets shared by Hub and APS, one per budget; budgets without a limit are not throttled."""
+
+    def __init__(self):
+        self.adaptive = False
+        self.latency_target = ADAPTIVE_LATENCY_TARGET
+        self._buckets = {}
+
+    def configure(self, limits):
+        limits = limits or {}
+        self.adaptive = limits.get('adaptive', False)
+        self.latency_target = limits.get('latency_target', ADAPTIVE_LATENCY_TARGET)
+        self._buckets = {
+            budget: TokenBucket(limits[budget], limits.get('burst'))
+            for budget in BUDGETS if limits.get(budget)
+        }
+
+    def acquire(self, budget):
+        bucket = self._buckets.get(budget)
+        if bucket:
+            bucket.acquire()
+
+    async def acquire_async(self, budget):
+        import asyncio
+
+        bucket = self._buckets.get(budget)
+        if bucket:
+            wait = bucket.take()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = bucket.take()
+
+    def report(self, budget, seconds, status=None, error=False):
+        bucket = self._buckets.get(budget)
+        if bucket and self.adaptive:
+            failed = error or status == 429 or (status is not None and status >= 500)
+            bucket.adapt(seconds, failed, self.latency_target)
+
+    def state(self):
+        return {budget: bucket.state() for budget, bucket in self._buckets.items()}
+
+    def log_state(self):
+        for budget, state in sorted(self.state().items()):
+            print("Rate limit {}: {rate}/s of {max_rate}/s, {requests} requests, {errors} errors, "
+                  "{waited}s waited".format(budget, **state))
+
+
+def aps_budget(method, uri):
+    if method == 'GET':
+        return 'read'
+    if method == 'POST' and uri.lstrip('/').startswith('aps/2/services/order-manager/orders'):
+        return 'order'
+    return 'write'
+
+
+governor = Governor()
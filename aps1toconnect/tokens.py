@@ -0,0 +1,56 @@
+import threading
+import time
+
+APS_TOKEN_TTL = 25 * 60
+
+
+class TokenManager(object):
+    """Caches APS tokens by (kind, id) and fetches a new one once expired or rejected."""
+
+    def __init__(self, fetch, ttl=APS_TOKEN_TTL):
+        self._fetch = fetch
+        self.ttl = ttl
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, key, stale=None):
+        with self._lock:
+            cached = self._tokens.get((kind, key))
+            if cached:
+                token, fetched = cached
+                if token != stale and time.monotonic() - fetched < self.ttl:
+                    return token
+            token = self._fetch(kind, key)
+            self._tokens[(kind, key)] = (token, time.monotonic())
+            return token
+
+    def source(self, kind, key):
+        return lambda stale=None: self.get(kind, key, stale)
+
+
+class AsyncTokenManager(object):
+    """TokenManager for AsyncHub, `fetch` is a coroutine function."""
+
+    def __init__(self, fetch, ttl=APS_TOKEN_TTL):
+        self._fetch = fetch
+        self.ttl = ttl
+        self._tokens = {}
+        self._lock = None
+
+    async def get(self, kind, key, stale=None):
+        import asyncio
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            cached = self._tokens.get((kind, key))
+            if cached:
+                token, fetched = cached
+                if token != stale and time.monotonic() - fetched < self.ttl:
+                    return token
+            token = await self._fetch(kind, key)
+            self._tokens[(kind, key)] = (token, time.monotonic())
+            return token
+
+    def source(self, kind, key):
+        return lambda stale=None: self.get(kind, key, stale)
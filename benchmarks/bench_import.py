@@ -0,0 +1,80 @@
+"""CLI startup benchmark: wall time of short commands and the heavy modules they import.
+
+Every sample is a fresh interpreter with a throwaway HOME, the way scripted health
+checks call the tool. --baseline times another tree the same way for comparison,
+either a checkout directory or a git ref exported from this repository.
+
+    python benchmarks/bench_import.py --runs 20
+    python benchmarks/bench_import.py --baseline HEAD~5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY_MODULES = ('osaapi', 'requests', 'urllib3', 'connect.client', 'fire', 'pkg_resources', 'distutils')
+
+COMMANDS = {
+    'import': "import aps1toconnect.migrator",
+    'info': "import sys; from aps1toconnect.migrator import main; sys.argv = ['aps1toconnect', 'info']; main()",
+}
+
+PROBE = "; import json, sys; sys.__stdout__.write(json.dumps(sorted(m for m in {} if m in sys.modules)))"
+
+
+def sample(code, env, tree):
+    start = time.monotonic()
+    output = subprocess.run(
+        [sys.executable, '-c', code + PROBE.format(HEAVY_MODULES)],
+        cwd=tree, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False,
+    ).stdout.decode('utf-8')
+    elapsed = time.monotonic() - start
+    loaded = json.loads(output.strip().splitlines()[-1]) if output.strip() else []
+    return elapsed, loaded
+
+
+def export_tree(baseline):
+    if os.path.isdir(baseline):
+        return os.path.abspath(baseline)
+    tree = tempfile.mkdtemp(prefix='aps1toconnect-baseline-')
+    archive = subprocess.run(['git', 'archive', baseline], stdout=subprocess.PIPE, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', tree], input=archive, check=True)
+    return tree
+
+
+def bench(label, tree, runs):
+    # python -c puts the working directory first on the path, running from the tree
+    # keeps another checkout or an installed aps1toconnect from shadowing it
+    env = dict(os.environ, HOME=tempfile.mkdtemp(prefix='aps1toconnect-bench-'))
+    env.pop('PYTHONPATH', None)
+    # Warm up the bytecode cache so compiling does not count as startup
+    sample(COMMANDS['import'], env, tree)
+
+    for name, code in COMMANDS.items():
+        times = []
+        loaded = []
+        for _ in range(runs):
+            elapsed, loaded = sample(code, env, tree)
+            times.append(elapsed)
+        print("{:<10} {:<8} {:>9.3f} {:>9.3f} {}".format(
+            label, name, statistics.median(times), min(times), ', '.join(loaded) or '-'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--baseline', help='checkout directory or git ref to compare against')
+    args = parser.parse_args()
+
+    print("{:<10} {:<8} {:>9} {:>9} {}".format('tree', 'command', 'median s', 'min s', 'heavy modules imported'))
+    if args.baseline:
+        bench('baseline', export_tree(args.baseline), args.runs)
+    bench('current', os.getcwd(), args.runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""End to end throughput benchmark of initiate_migration against the local simulator.
+
+Every fleet size runs in its own process with a throwaway HOME, so configuration,
+journal and logs never touch ~/.connect.
+
+    PYTHONPATH=. python benchmarks/bench_migration.py --sizes 10,1000,50000 --workers 32
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_once(args):
+    home = tempfile.mkdtemp(prefix='aps1toconnect-bench-')
+    os.environ['HOME'] = home
+    sys.path.insert(0, HERE)
+    from simulator import Simulator, install
+
+    simulator = Simulator(
+        instances=args.run,
+        plans=args.plans,
+        resources=args.resources,
+        rpc_latency=args.latency,
+        aps_latency=args.latency,
+        connect_latency=args.latency,
+    )
+    os.makedirs(os.path.join(home, '.connect'))
+    with open(os.path.join(home, '.connect', '.env_config'), 'w') as f:
+        json.dump(simulator.hub_config(), f)
+    with open(os.path.join(home, '.connect', 'migration.json'), 'w') as f:
+        json.dump(simulator.migration_config(), f)
+
+    from aps1toconnect import migrator
+    migrator._init_output()
+    sys.stdout.terminal = None
+    sys.stderr.terminal = None
+    install(simulator)
+
+    start = time.monotonic()
+    migrator.Migrator().initiate_migration(workers=args.workers)
+    elapsed = time.monotonic() - start
+    sys.__stdout__.write(json.dumps({
+        'instances': args.run,
+        'seconds': elapsed,
+        'round_trips': simulator.round_trips,
+        'calls': dict(simulator.calls),
+    }) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10,1000')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every simulated round trip')
+    parser.add_argument('--plans', type=int, default=4)
+    parser.add_argument('--resources', type=int, default=5)
+    parser.add_argument('--verbose', action='store_true', help='print round trips per endpoint')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_once(args)
+        return
+
+    print("{:>9} {:>9} {:>12} {:>12} {:>14}".format(
+        'instances', 'seconds', 'inst/s', 'round trips', 'trips/instance'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--run', str(size), '--workers', str(args.workers),
+             '--latency', str(args.latency), '--plans', str(args.plans),
+             '--resources', str(args.resources)],
+        )
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        print("{:>9} {:>9.2f} {:>12.1f} {:>12} {:>14.2f}".format(
+            result['instances'], result['seconds'], result['instances'] / result['seconds'],
+            result['round_trips'], result['round_trips'] / result['instances']))
+        if args.verbose:
+            for call, count in sorted(result['calls'].items()):
+                print("    {:<90} {:>8}".format(call, count))
+
+
+if __name__ == '__main__':
+    main()
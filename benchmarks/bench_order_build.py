@@ -0,0 +1,72 @@
+"""Micro-benchmark of change order construction on large plans.
+
+Compares the former per-subscription linear scan of the target plan
+resourceRates against the resource map precomputed once per plan.
+
+    PYTHONPATH=. python benchmarks/bench_order_build.py [resources] [subscriptions]
+"""
+import sys
+import timeit
+
+from aps1toconnect.migrator import _build_order, _plan_resource_map
+
+
+def legacy_build_order(bss_subscription, new_plan, resources, mappings, new_plan_data):
+    order = {
+        "type": "CHANGE",
+        "subscriptionId": bss_subscription['aps']['id'],
+        "period": bss_subscription['subscriptionPeriod'],
+        "planId": new_plan,
+        "resources": []
+    }
+    for resource in resources:
+        new_resource_id = ""
+        for new_resource in new_plan_data['resourceRates']:
+            if new_resource['resourceId'] in mappings[resource['resourceId']]:
+                new_resource_id = new_resource['resourceId']
+        order['resources'].append({
+            "resourceId": new_resource_id,
+            "amount": int(resource['included'] + resource['additional'])
+        })
+    return order
+
+
+def main(resources_count=500, subscriptions=200):
+    sources = ['src-{}'.format(i) for i in range(resources_count)]
+    legacy_mappings = {src: ['dst-{}-a'.format(src), 'dst-{}-b'.format(src)] for src in sources}
+    mappings = {src: frozenset(dests) for src, dests in legacy_mappings.items()}
+    new_plan_data = {'resourceRates': [
+        {'resourceId': 'dst-{}-b'.format(src)} for src in sources
+    ]}
+    resources = [
+        {'id': i, 'resourceId': src, 'included': 1, 'additional': 2}
+        for i, src in enumerate(sources)
+    ]
+    bss_subscription = {'aps': {'id': 'sub'}, 'subscriptionPeriod': {}}
+
+    def legacy():
+        for _ in range(subscriptions):
+            legacy_build_order(bss_subscription, 'plan', resources, legacy_mappings, new_plan_data)
+
+    def indexed():
+        resource_map = _plan_resource_map(new_plan_data, mappings)
+        for _ in range(subscriptions):
+            _build_order(bss_subscription, 'plan', resources, mappings, resource_map)
+
+    assert legacy_build_order(bss_subscription, 'plan', resources, legacy_mappings, new_plan_data) == \
+        _build_order(bss_subscription, 'plan', resources, mappings,
+                     _plan_resource_map(new_plan_data, mappings))
+
+    legacy_time = min(timeit.repeat(legacy, number=1, repeat=3))
+    indexed_time = min(timeit.repeat(indexed, number=1, repeat=3))
+    sys.__stdout__.write(
+        "{} resources x {} subscriptions\n"
+        "  linear scan: {:.4f}s\n"
+        "  indexed:     {:.4f}s\n"
+        "  speedup:     {:.1f}x\n".format(
+            resources_count, subscriptions, legacy_time, indexed_time, legacy_time / indexed_time)
+    )
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
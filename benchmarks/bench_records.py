@@ -0,0 +1,80 @@
+"""Memory held by the instance records of a large fleet, RPC dicts against InstanceRecord.
+
+    PYTHONPATH=. python benchmarks/bench_records.py --instances 100000 --settings 20
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from aps1toconnect.records import InstanceRecord
+
+KEYS = {'subscription_id', 'tenant_domain', 'admin_email'}
+
+
+def rpc_settings(instance_id, settings):
+    names = sorted(KEYS) + [f'setting_{i}' for i in range(settings - len(KEYS))]
+    return [{'name': name, 'value': f'{name}-{instance_id}'} for name in names]
+
+
+def as_dicts(instances, settings):
+    return [
+        {'instance_id': i, 'status': 'Ready', 'package_version': '1.0-2',
+         'settings': rpc_settings(i, settings)}
+        for i in range(instances)
+    ]
+
+
+def as_records(instances, settings):
+    details = {'status': 'Ready', 'package_version': '1.0-2'}
+    return [
+        InstanceRecord.from_rpc(i, details, rpc_settings(i, settings), KEYS)
+        for i in range(instances)
+    ]
+
+
+def measure(build, instances, settings):
+    gc.collect()
+    tracemalloc.start()
+    records = build(instances, settings)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return records, size
+
+
+def lookups(records, get):
+    start = time.perf_counter()
+    for record in records:
+        for key in KEYS:
+            get(record, key)
+    return time.perf_counter() - start
+
+
+def scan(record, key):
+    for setting in record['settings']:
+        if setting['name'] == key:
+            return setting['value']
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--instances', type=int, default=100000)
+    parser.add_argument('--settings', type=int, default=20, help='settings per instance')
+    args = parser.parse_args()
+
+    dicts, dicts_size = measure(as_dicts, args.instances, args.settings)
+    dicts_time = lookups(dicts, scan)
+    del dicts
+    records, records_size = measure(as_records, args.instances, args.settings)
+    records_time = lookups(records, InstanceRecord.setting)
+
+    print("{:<16} {:>10} {:>14} {:>12}".format('representation', 'MB', 'bytes/inst', 'lookups s'))
+    for name, size, seconds in (('rpc dicts', dicts_size, dicts_time),
+                                ('InstanceRecord', records_size, records_time)):
+        print("{:<16} {:>10.1f} {:>14.0f} {:>12.3f}".format(
+            name, size / 2 ** 20, size / args.instances, seconds))
+
+
+if __name__ == '__main__':
+    main()
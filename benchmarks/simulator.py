@@ -0,0 +1,310 @@
+"""Local stand-in for the CloudBlue Commerce hub and Connect endpoints used by the tool.
+
+The simulator serves the OSA RPC calls, the APS REST resources and the Connect
+purchase requests a migration needs, with configurable latency and fleet size,
+and counts every round trip it answers. install() patches the aps1toconnect
+modules so that Hub, APS and ConnectClient talk to it instead of the network.
+"""
+import json
+import re
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+from urllib.parse import unquote, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+
+SOURCE_VERSION = '1.0-1'
+SAFE_DELETE_VERSION = '1.0-2'
+SUBSCRIPTION_SETTING = 'subscription_id'
+PARAMS = {'tenant_domain': 'domain', 'admin_email': 'email'}
+PRODUCT_ID = 'PRD-000-000-000'
+TEMPLATE_ID = 'TL-000-000-000'
+POA_TYPE = 'http://parallels.com/aps/types/pa/poa/1.0'
+
+_IMPLEMENTING = re.compile(r'implementing\(([^)]*)\)')
+_IN = re.compile(r'\bin\(([\w.]+),\(([^)]*)\)\)')
+_EQ = re.compile(r'\beq\(([\w.]+),([^)]*)\)')
+_LIMIT = re.compile(r'\blimit\((\d+),(\d+)\)')
+
+
+class Simulator(object):
+    def __init__(self, instances=10, plans=4, resources=5, rpc_latency=0.0, aps_latency=0.0,
+                 connect_latency=0.0, order_delay=0.0):
+        self.rpc_latency = rpc_latency
+        self.aps_latency = aps_latency
+        self.connect_latency = connect_latency
+        self.order_delay = order_delay
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._orders = {}
+        self._tenants = {}
+        self._requests = {}
+        self._build(instances, plans, resources)
+
+    def _build(self, instances, plans, resources):
+        self.mapping = {str(i): [str(100 + i)] for i in range(1, resources + 1)}
+        self.billing_resources = {}
+        for source, destinations in self.mapping.items():
+            self.billing_resources[source] = {'id': int(source), 'aps': {'id': f'res-src-{source}'}}
+            for dest in destinations:
+                self.billing_resources[dest] = {'id': int(dest), 'aps': {'id': f'res-dst-{dest}'}}
+        self.plans = {
+            f'plan-new-{p}': {
+                'aps': {'id': f'plan-new-{p}'},
+                'resourceRates': [{'resourceId': f'res-dst-{100 + i}'} for i in range(1, resources + 1)],
+            }
+            for p in range(plans)
+        }
+        self.instances = {}
+        self.bss = {}
+        self.oss = {}
+        for i in range(instances):
+            instance_id = i + 1
+            subscription = 100000 + i
+            self.instances[instance_id] = {
+                'status': 'Ready',
+                'package_version': SAFE_DELETE_VERSION,
+                'settings': [{'name': SUBSCRIPTION_SETTING, 'value': str(subscription)}] + [
+                    {'name': key, 'value': f'{key}-{instance_id}'} for key in PARAMS
+                ],
+            }
+            self.bss[str(subscription)] = {
+                'aps': {'id': f'bss-{subscription}'},
+                'subscriptionId': subscription,
+                'status': 'ACTIVE',
+                'subscriptionPeriod': {'duration': 1, 'unit': 'MONTH'},
+                'servicePlan': {'aps': {'id': f'plan-old-{i % plans}'}},
+                'resources': [
+                    {'id': r, 'resourceId': f'res-src-{r}', 'included': 1, 'additional': 2}
+                    for r in range(1, resources + 1)
+                ],
+            }
+            self.oss[str(subscription)] = {'aps': {'id': f'oss-{subscription}'}, 'subscriptionId': subscription}
+
+    def migration_config(self, **overrides):
+        config = {
+            'APP_APP_ID': 'http://example.com/app',
+            'APP_SOURCE_VERSION': SOURCE_VERSION,
+            'APP_SAFE_DELETE_VERSION': SAFE_DELETE_VERSION,
+            'SUBSCRIPTION_ID_SETTING': SUBSCRIPTION_SETTING,
+            'RESOURCE_MAPPING': self.mapping,
+            'PARAMS_MAPPING': PARAMS,
+            'CONNECT_PRODUCT_ID': PRODUCT_ID,
+            'CONNECT_API_KEY': 'ApiKey SU-000:simulated',
+            'CONNECT_API_ENDPOINT': 'https://connect.local/public/v1',
+            'CONNECT_ACTIVATION_TEMPLATE': TEMPLATE_ID,
+            'ORDER_POLL': {'min_interval': 0.01, 'max_interval': 0.2, 'rate': 1000},
+            'CONNECT_POLL': {'interval': 0.05},
+        }
+        config.update(overrides)
+        return config
+
+    @staticmethod
+    def hub_config():
+        return {'host': 'hub.local', 'user': 'admin', 'password': 'simulated', 'ssl': False,
+                'port': 8440, 'aps_host': 'hub.local', 'aps_port': 6308, 'use_tls_aps': True}
+
+    def _count(self, kind, latency):
+        with self._lock:
+            self.calls[kind] += 1
+        if latency:
+            time.sleep(latency)
+
+    @property
+    def round_trips(self):
+        return sum(self.calls.values())
+
+    # OSA RPC
+
+    def rpc_client(self, **params):
+        return SimulatedOSA(self)
+
+    def rpc(self, method, **kwargs):
+        self._count(f'rpc {method}', self.rpc_latency)
+        if method == 'getStatisticsReport':
+            result = [{'value': '<Builds><Build><Build>simulated</Build></Build></Builds>'}]
+        elif method == 'getUserToken':
+            result = {'aps_token': 'simulated-token'}
+        elif method == 'getApplications':
+            result = [{'application_id': 1}]
+        elif method == 'getApplicationInstances':
+            result = [
+                {'application_instance_id': instance_id, 'status': inst['status'],
+                 'package_version': inst['package_version']}
+                for instance_id, inst in self.instances.items()
+            ]
+        elif method == 'getApplicationInstance':
+            inst = self.instances[kwargs['application_instance_id']]
+            result = {'status': inst['status'], 'package_version': inst['package_version']}
+        elif method == 'getApplicationInstanceSettings':
+            result = self.instances[kwargs['application_instance_id']]['settings']
+        else:
+            return {'status': -1, 'error_message': f'{method} is not simulated'}
+        return {'status': 0, 'result': result}
+
+    # APS REST
+
+    def session(self):
+        session = requests.Session()
+        adapter = SimulatedAdapter(self)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def aps(self, method, path, query, body):
+        self._count(f'aps {method} {_kind(path, query)}', self.aps_latency)
+        parts = path.strip('/').split('/')[2:]
+        if method == 'GET' and parts == ['resources']:
+            return 200, self._query(query)
+        if method == 'GET' and parts[:1] == ['resources'] and len(parts) == 3 and parts[2] == 'resources':
+            return 200, self.bss[parts[1].split('-', 1)[1]]['resources']
+        if method == 'GET' and parts[:1] == ['resources'] and len(parts) == 2:
+            return 200, self.plans.get(parts[1], {})
+        if method == 'POST' and parts[:1] == ['resources'] and parts[-1:] == ['planPeriodSwitches']:
+            old = parts[1]
+            return 200, [{'target': {'planId': old}}, {'target': {'planId': old.replace('old', 'new')}}]
+        if method == 'POST' and parts == ['services', 'order-manager', 'orders']:
+            with self._lock:
+                order_id = len(self._orders) + 1
+                self._orders[order_id] = time.monotonic() + self.order_delay
+            return 200, {'orderId': order_id}
+        if method == 'GET' and parts[:3] == ['services', 'order-manager', 'orders']:
+            ready = self._orders[int(parts[3])] <= time.monotonic()
+            return 200, {'provisioningStatus': 'COMPLETED' if ready else 'PROVISIONING'}
+        if method == 'POST' and parts == ['resources']:
+            with self._lock:
+                tenant_id = f'tenant-{len(self._tenants) + 1}'
+                self._tenants[tenant_id] = body
+                subscription = body['_subscription'].split('-', 1)[1]
+                self._requests[f'PR-{subscription}'] = {
+                    'id': f'PR-{subscription}',
+                    'status': 'pending',
+                    'asset': {'external_id': subscription},
+                }
+            return 200, {'aps': {'id': tenant_id}}
+        return 404, {'error': 'NotFound', 'message': f'{method} {path} is not simulated'}
+
+    def _query(self, query):
+        types = _IMPLEMENTING.findall(query)
+        if POA_TYPE in types:
+            return [{'aps': {'id': 'simulated-hub'}}]
+        if 'Subscription/1.0' in query and 'billing' in query:
+            collection = self.bss
+        elif 'subscription/1.0' in query:
+            collection = self.oss
+        else:
+            collection = self.billing_resources
+        match = _IN.search(query) or _EQ.search(query)
+        values = match.group(2).split(',') if match else []
+        found = [
+            {k: v for k, v in collection[value.strip()].items() if k != 'resources'}
+            for value in values if value.strip() in collection
+        ]
+        total = len(found)
+        limit = _LIMIT.search(query)
+        if not limit:
+            return found
+        offset, count = int(limit.group(1)), int(limit.group(2))
+        page = _Page(found[offset:offset + count])
+        page.content_range = f'items {offset}-{offset + len(page) - 1}/{total}'
+        return page
+
+    # Connect
+
+    def connect_client(self, **params):
+        return SimulatedConnect(self)
+
+    def connect_filter(self, query):
+        self._count('connect requests.filter', self.connect_latency)
+        match = re.search(r'in\(asset\.external_id,\(([^)]*)\)\)', str(query))
+        wanted = set(match.group(1).split(',')) if match else set()
+        with self._lock:
+            return [dict(request) for request in self._requests.values()
+                    if request['asset']['external_id'] in wanted]
+
+    def connect_approve(self, request_id, payload):
+        self._count('connect requests.approve', self.connect_latency)
+        with self._lock:
+            self._requests[request_id]['status'] = 'approved'
+
+
+class _Page(list):
+    content_range = None
+
+
+def _kind(path, query):
+    segments = path.strip('/').split('/')
+    path = '/'.join(segments[:2] + [re.sub(r'^[\w-]*\d[\w-]*$', '{id}', segment) for segment in segments[2:]])
+    types = _IMPLEMENTING.findall(query)
+    return path + (f'?implementing({types[0]})' if types else '')
+
+
+class SimulatedOSA(object):
+    def __init__(self, simulator):
+        self.aps = self.APS = self.statistics = _RPCNamespace(simulator)
+
+
+class _RPCNamespace(object):
+    def __init__(self, simulator):
+        self._simulator = simulator
+
+    def __getattr__(self, method):
+        return lambda **kwargs: self._simulator.rpc(method, **kwargs)
+
+
+class SimulatedAdapter(BaseAdapter):
+    def __init__(self, simulator):
+        super(SimulatedAdapter, self).__init__()
+        self.simulator = simulator
+        self.poolmanager = SimpleNamespace(pools={})
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        body = json.loads(request.body) if request.body else None
+        if isinstance(body, dict) and request.headers.get('APS-Subscription-ID'):
+            body = dict(body, _subscription=request.headers['APS-Subscription-ID'])
+        status, payload = self.simulator.aps(request.method, url.path, unquote(url.query), body)
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(payload).encode('utf-8')
+        response.headers['Content-Type'] = 'application/json'
+        if getattr(payload, 'content_range', None):
+            response.headers['Content-Range'] = payload.content_range
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class SimulatedConnect(object):
+    def __init__(self, simulator):
+        self.requests = _SimulatedRequests(simulator)
+
+
+class _SimulatedRequests(object):
+    def __init__(self, simulator):
+        self._simulator = simulator
+
+    def filter(self, query):
+        return SimpleNamespace(all=lambda: self._simulator.connect_filter(query))
+
+    def __getitem__(self, request_id):
+        simulator = self._simulator
+        return SimpleNamespace(action=lambda name: SimpleNamespace(
+            post=lambda payload: simulator.connect_approve(request_id, payload)
+        ))
+
+
+def install(simulator):
+    """Points aps1toconnect at the simulator."""
+    import connect.client
+    from aps1toconnect import hub
+
+    hub.osaapi = SimpleNamespace(OSA=simulator.rpc_client)
+    hub.APS._get_session = staticmethod(lambda pool_size: simulator.session())
+    connect.client.ConnectClient = simulator.connect_client
@@ -26,6 +26,9 @@ setup(
     url='https://github.com/cloudblue/aps1toconnect',
     license='Apache Software License',
     install_requires=install_reqs,
+    extras_require={
+        'async': ['aiohttp>=3.7'],
+    },
     entry_points={
         'console_scripts': [
             'aps1toconnect = aps1toconnect.migrator:main',